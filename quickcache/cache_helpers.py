@@ -1,12 +1,42 @@
+import bisect
+import hashlib
+import logging
+import threading
 import warnings
 from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from time import perf_counter
 from .logger import logger
 
 
+# number of locks (and version tags) TieredCache spreads keys over
+LOCK_STRIPES = 64
+
+
 class ForceSkipCache(Exception):
     pass
 
 
+class _LazyThreadPool:
+    """
+    A ThreadPoolExecutor that isn't started until it's first needed
+    """
+
+    def __init__(self, max_workers, thread_name_prefix):
+        self.max_workers = max_workers
+        self.thread_name_prefix = thread_name_prefix
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.max_workers, thread_name_prefix=self.thread_name_prefix)
+        return self._executor
+
+
 class CacheWithPresets(namedtuple('CacheWithPresets', ['cache', 'timeout', 'prefix_function'])):
 
     # make prefix_function optional
@@ -54,29 +84,297 @@ class TieredCache:
     Relies on each of the caches' default timeout;
     TieredCache.set doesn't accept a timeout parameter
 
+    If `hedge_delay` (in seconds) is given, a cache that hasn't answered
+    within `hedge_delay` doesn't hold up the next one:
+    the caches between the first and the last are looked up from a thread pool
+    (of `max_workers` threads, shared by all lookups),
+    and the next cache is asked as soon as the previous one misses
+    or has taken longer than `hedge_delay`.
+    The first and last caches are looked up in the calling thread,
+    so with only two caches there's nothing to hedge and no threads are used.
+    The first cache that hits wins (the earliest one, if several have answered),
+    lookups still in flight are cancelled or ignored,
+    and the caches before the winner are backfilled as usual.
+
+    Concurrent use from several threads is safe, and deletes win:
+    every set and delete bumps a version tag for the key (shared by a stripe of keys),
+    and a get only backfills the caches it missed if the version hasn't changed
+    since it started, so a late backfill can't bring back a value that was
+    deleted or overwritten in the meantime.
+    This only covers sets and deletes made through this TieredCache in this process.
+
     """
 
-    def __init__(self, caches):
+    def __init__(self, caches, hedge_delay=None, max_workers=None):
         self.caches = caches
+        self.hedge_delay = hedge_delay
+        self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self._versions = [0] * LOCK_STRIPES
+        self._pool = _LazyThreadPool(max_workers, thread_name_prefix='quickcache-tier')
 
-    def get(self, key, default=None):
+    def get(self, key, default=None, on_lookup=None):
+        """
+        `on_lookup`, if given, is called as on_lookup(cache, hit, duration)
+        after looking in each cache
+        """
+        stripe = hash(key) % LOCK_STRIPES
+        version = self._versions[stripe]
+        if self.hedge_delay is not None and len(self.caches) > 2:
+            return self._hedged_get(key, default, on_lookup, stripe, version)
         missed = []
         for cache in self.caches:
-            content = cache.get(key, default=Ellipsis)
+            if on_lookup is None:
+                content = cache.get(key, default=Ellipsis)
+            else:
+                content, duration = self._timed_get(cache, key)
+                on_lookup(cache, content is not Ellipsis, duration)
             if content is not Ellipsis:
-                for missed_cache in missed:
-                    missed_cache.set(key, content)
-                logger.debug('missed caches: %s', [c.__class__.__name__ for c in missed])
-                logger.debug('hit cache: %s', cache.__class__.__name__)
+                self._backfill(key, content, missed, cache, stripe, version)
                 return content
             else:
                 missed.append(cache)
         return default
 
+    @staticmethod
+    def _timed_get(cache, key):
+        start = perf_counter()
+        content = cache.get(key, default=Ellipsis)
+        return content, perf_counter() - start
+
+    def _backfill(self, key, content, missed, hit_cache, stripe, version):
+        if missed:
+            with self._locks[stripe]:
+                if self._versions[stripe] != version:
+                    # set or deleted since we looked it up
+                    return
+                for missed_cache in missed:
+                    missed_cache.set(key, content)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('missed caches: %s', [c.__class__.__name__ for c in missed])
+            logger.debug('hit cache: %s', hit_cache.__class__.__name__)
+
+    def _hedged_get(self, key, default, on_lookup, stripe, version):
+        # the first cache is expected to be local, so isn't worth a thread
+        content, duration = self._timed_get(self.caches[0], key)
+        if on_lookup is not None:
+            on_lookup(self.caches[0], content is not Ellipsis, duration)
+        if content is not Ellipsis:
+            return content
+
+        executor = self._pool.get()
+        last = len(self.caches) - 1
+        pending = {}
+        hits = {}
+
+        def collect(done):
+            for future in done:
+                index = pending.pop(future)
+                content, duration = future.result()
+                if on_lookup is not None:
+                    on_lookup(self.caches[index], content is not Ellipsis, duration)
+                if content is not Ellipsis:
+                    hits[index] = content
+
+        for index in range(1, last):
+            pending[executor.submit(self._timed_get, self.caches[index], key)] = index
+            done, _ = wait(pending, timeout=self.hedge_delay, return_when=FIRST_COMPLETED)
+            collect(done)
+            if hits:
+                break
+        else:
+            # nothing after the last cache to hedge towards, so ask it from this thread
+            content, duration = self._timed_get(self.caches[last], key)
+            if on_lookup is not None:
+                on_lookup(self.caches[last], content is not Ellipsis, duration)
+            if content is not Ellipsis:
+                hits[last] = content
+            collect([future for future in pending if future.done()])
+            while pending and not hits:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+
+        for future in pending:
+            future.cancel()
+        if not hits:
+            return default
+        index = min(hits)
+        self._backfill(key, hits[index], self.caches[:index], self.caches[index],
+                       stripe, version)
+        return hits[index]
+
     def set(self, key, value):
-        for cache in self.caches:
-            cache.set(key, value)
+        stripe = hash(key) % LOCK_STRIPES
+        with self._locks[stripe]:
+            for cache in self.caches:
+                cache.set(key, value)
+            # bumped after writing, so that a get that read the version
+            # while we were writing doesn't backfill
+            self._versions[stripe] += 1
 
     def delete(self, key):
-        for cache in self.caches:
-            cache.delete(key)
+        stripe = hash(key) % LOCK_STRIPES
+        with self._locks[stripe]:
+            for cache in self.caches:
+                cache.delete(key)
+            # see set
+            self._versions[stripe] += 1
+
+
+class ShardedCache:
+    """
+    Spreads keys over a number of caches using a consistent-hash ring
+
+    Each shard is placed on the ring `replicas` times (virtual nodes)
+    so that keys are spread evenly and adding or removing a shard only moves
+    the keys that hashed to that shard.
+    `caches` may be a list, or a dict of shard name to cache;
+    use a dict if shards may be added or removed,
+    since list positions are used as the shard names otherwise.
+
+    A shard that raises is treated as a miss on get and ignored on set/delete
+    (the error is logged), so callers fall through to computing the value.
+    ForceSkipCache is handled the same way, but quietly.
+
+    The bulk operations (get_many, set_many, delete_many) group keys by shard
+    and talk to the shards in parallel.
+
+    """
+
+    def __init__(self, caches, replicas=100, max_workers=None):
+        if not isinstance(caches, dict):
+            caches = {str(index): cache for index, cache in enumerate(caches)}
+        if not caches:
+            raise ValueError("ShardedCache needs at least one cache")
+        self.names = list(caches)
+        self.caches = list(caches.values())
+        ring = sorted(
+            (self._hash(f'{name}:{replica}'), index)
+            for index, name in enumerate(self.names)
+            for replica in range(replicas)
+        )
+        self._ring_hashes = [point for point, _ in ring]
+        self._ring_shards = [index for _, index in ring]
+        self._pool = _LazyThreadPool(max_workers or len(self.caches),
+                                     thread_name_prefix='quickcache-shard')
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+    def _shard_index(self, key):
+        position = bisect.bisect(self._ring_hashes, self._hash(key))
+        return self._ring_shards[position % len(self._ring_shards)]
+
+    def get_shard(self, key):
+        return self.caches[self._shard_index(key)]
+
+    def _group_by_shard(self, keys):
+        groups = {}
+        for key in keys:
+            groups.setdefault(self._shard_index(key), []).append(key)
+        return groups
+
+    def _map_shards(self, func, groups):
+        if len(groups) <= 1:
+            return [func(index, items) for index, items in groups.items()]
+        return list(self._pool.get().map(lambda item: func(*item), groups.items()))
+
+    def _log_failure(self, operation, index):
+        logger.warning('quickcache shard %s failed on %s; skipping it',
+                       self.names[index], operation, exc_info=True)
+
+    def get(self, key, default=None):
+        index = self._shard_index(key)
+        try:
+            return self.caches[index].get(key, default=default)
+        except ForceSkipCache:
+            return default
+        except Exception:
+            self._log_failure('get', index)
+            return default
+
+    def set(self, key, value, timeout=Ellipsis):
+        index = self._shard_index(key)
+        try:
+            if timeout is Ellipsis:
+                self.caches[index].set(key, value)
+            else:
+                self.caches[index].set(key, value, timeout=timeout)
+        except ForceSkipCache:
+            pass
+        except Exception:
+            self._log_failure('set', index)
+
+    def delete(self, key):
+        index = self._shard_index(key)
+        try:
+            self.caches[index].delete(key)
+        except ForceSkipCache:
+            pass
+        except Exception:
+            self._log_failure('delete', index)
+
+    def get_many(self, keys):
+        """
+        :returns: a dict of the keys that were found to their values
+        """
+        def get_shard_many(index, shard_keys):
+            cache = self.caches[index]
+            try:
+                if hasattr(cache, 'get_many'):
+                    return cache.get_many(shard_keys)
+                found = {}
+                for key in shard_keys:
+                    value = cache.get(key, default=Ellipsis)
+                    if value is not Ellipsis:
+                        found[key] = value
+                return found
+            except ForceSkipCache:
+                return {}
+            except Exception:
+                self._log_failure('get_many', index)
+                return {}
+
+        result = {}
+        for found in self._map_shards(get_shard_many, self._group_by_shard(keys)):
+            result.update(found)
+        return result
+
+    def set_many(self, mapping, timeout=Ellipsis):
+        def set_shard_many(index, shard_keys):
+            cache = self.caches[index]
+            try:
+                if hasattr(cache, 'set_many'):
+                    shard_mapping = {key: mapping[key] for key in shard_keys}
+                    if timeout is Ellipsis:
+                        cache.set_many(shard_mapping)
+                    else:
+                        cache.set_many(shard_mapping, timeout=timeout)
+                    return
+                for key in shard_keys:
+                    if timeout is Ellipsis:
+                        cache.set(key, mapping[key])
+                    else:
+                        cache.set(key, mapping[key], timeout=timeout)
+            except ForceSkipCache:
+                pass
+            except Exception:
+                self._log_failure('set_many', index)
+
+        self._map_shards(set_shard_many, self._group_by_shard(mapping))
+
+    def delete_many(self, keys):
+        def delete_shard_many(index, shard_keys):
+            cache = self.caches[index]
+            try:
+                if hasattr(cache, 'delete_many'):
+                    cache.delete_many(shard_keys)
+                    return
+                for key in shard_keys:
+                    cache.delete(key)
+            except ForceSkipCache:
+                pass
+            except Exception:
+                self._log_failure('delete_many', index)
+
+        self._map_shards(delete_shard_many, self._group_by_shard(keys))
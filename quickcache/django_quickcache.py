@@ -1,8 +1,8 @@
 from collections import namedtuple
 
 from django.core.cache import caches
-from .quickcache import ConfigMixin, get_quickcache, assert_function
-from .cache_helpers import CacheWithPresets, TieredCache
+from .quickcache import ConfigMixin, HELPER_OPTION_DEFAULTS, get_quickcache, assert_function
+from .cache_helpers import CacheWithPresets, ShardedCache, TieredCache
 from .quickcache_helper import QuickCacheHelper
 
 
@@ -14,6 +14,17 @@ class DjangoQuickCache(namedtuple('DjangoQuickCache', [
     'helper_class',
     'assert_function',
     'session_function',
+    'refresh_ahead',
+    'cache_exceptions',
+    'negative_results',
+    'negative_timeout',
+    'hooks',
+    'memoize_on_instance',
+    'fingerprint',
+    'depends_on',
+    'key_format',
+    'offload',
+    'offload_timeout',
 ]), ConfigMixin):
 
     def call(self):
@@ -25,17 +36,37 @@ class DjangoQuickCache(namedtuple('DjangoQuickCache', [
             skip_arg=self.skip_arg,
             helper_class=self.helper_class,
             assert_function=self.assert_function,
+            **{name: getattr(self, name) for name in HELPER_OPTION_DEFAULTS}
         ).call()
 
 
 def tiered_django_cache(cache_with_preset_arg_lists):
+    """
+    A cache_name may also be a list or tuple of cache names,
+    in which case that tier is sharded across those caches
+    """
     return TieredCache([
-        CacheWithPresets(caches[cache_name], timeout, session_function)
+        CacheWithPresets(_django_cache(cache_name), timeout, session_function)
         for cache_name, timeout, session_function in cache_with_preset_arg_lists
         if timeout
     ])
 
 
+# one ShardedCache per combination of cache names, shared by every decorated function
+_sharded_caches = {}
+
+
+def _django_cache(cache_name):
+    if isinstance(cache_name, (list, tuple)):
+        cache_names = tuple(cache_name)
+        sharded_cache = _sharded_caches.get(cache_names)
+        if sharded_cache is None:
+            sharded_cache = _sharded_caches.setdefault(
+                cache_names, ShardedCache({name: caches[name] for name in cache_names}))
+        return sharded_cache
+    return caches[cache_name]
+
+
 get_django_quickcache = DjangoQuickCache(
     vary_on=Ellipsis,
     skip_arg=None,
@@ -44,4 +75,5 @@ get_django_quickcache = DjangoQuickCache(
     helper_class=QuickCacheHelper,
     assert_function=assert_function,
     session_function=None,
+    **HELPER_OPTION_DEFAULTS
 ).but_with
@@ -0,0 +1,83 @@
+import threading
+import time
+
+from opentelemetry import context, trace
+from opentelemetry.trace import Status, StatusCode
+
+from .tracing import CacheHooks
+
+
+class OpenTelemetryHooks(CacheHooks):
+    """
+    Records a span for each (sampled) call,
+    with child spans for building the key, each tier lookup, the recompute and the set
+
+    While the function is recomputed its span is the current span,
+    so spans started by the function nest under it.
+
+    Combine with `SampledHooks` to only trace one in N calls.
+
+    """
+
+    def __init__(self, tracer=None):
+        self.tracer = tracer or trace.get_tracer('quickcache')
+        self._local = threading.local()
+
+    @property
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def _parent_context(self):
+        if not self._stack:
+            return None
+        call_span, compute_span, _ = self._stack[-1]
+        return trace.set_span_in_context(compute_span or call_span)
+
+    def _child_span(self, name, duration, **attributes):
+        end_time = time.time_ns()
+        span = self.tracer.start_span(name, context=self._parent_context(),
+                                      start_time=end_time - int(duration * 1e9),
+                                      attributes=attributes)
+        span.end(end_time=end_time)
+
+    def before_lookup(self, helper, key, duration):
+        start_time = time.time_ns() - int(duration * 1e9)
+        call_span = self.tracer.start_span(f'quickcache {helper.fn.__name__}',
+                                           context=self._parent_context(),
+                                           start_time=start_time,
+                                           attributes={'quickcache.key': key})
+        self._stack.append([call_span, None, None])
+        self._child_span('quickcache.key', duration)
+
+    def tier_hit(self, helper, key, tier, duration):
+        self._child_span('quickcache.get', duration, **{
+            'quickcache.tier': tier.__class__.__name__, 'quickcache.hit': True})
+
+    def tier_miss(self, helper, key, tier, duration):
+        self._child_span('quickcache.get', duration, **{
+            'quickcache.tier': tier.__class__.__name__, 'quickcache.hit': False})
+
+    def compute_start(self, helper, key):
+        compute_span = self.tracer.start_span('quickcache.compute', context=self._parent_context())
+        token = context.attach(trace.set_span_in_context(compute_span))
+        self._stack[-1][1:] = [compute_span, token]
+
+    def compute_end(self, helper, key, duration, error):
+        _, compute_span, token = self._stack[-1]
+        self._stack[-1][1:] = [None, None]
+        context.detach(token)
+        if error is not None:
+            compute_span.record_exception(error)
+            compute_span.set_status(Status(StatusCode.ERROR))
+        compute_span.end()
+
+    def set(self, helper, key, duration):
+        self._child_span('quickcache.set', duration)
+
+    def end(self, helper, key, duration):
+        call_span, _, _ = self._stack.pop()
+        call_span.end()
@@ -6,6 +6,24 @@ from .logger import assert_function
 from .quickcache_helper import QuickCacheHelper
 
 
+# Options added since helper_class became configurable. They're only passed
+# to helper_class when they're set, so that helper classes written for
+# the original QuickCacheHelper.__init__ signature keep working.
+HELPER_OPTION_DEFAULTS = {
+    'refresh_ahead': None,
+    'cache_exceptions': (),
+    'negative_results': (),
+    'negative_timeout': None,
+    'hooks': None,
+    'memoize_on_instance': False,
+    'fingerprint': 'source',
+    'depends_on': (),
+    'key_format': 'default',
+    'offload': None,
+    'offload_timeout': None,
+}
+
+
 class ConfigMixin:
     def but_with(self, **defaults):
         return self._replace(**defaults)
@@ -31,6 +49,9 @@ class ConfigMixin:
     def call(self):
         helper_class_kwargs = self._asdict()
         helper_class = helper_class_kwargs.pop('helper_class')
+        for name, default in HELPER_OPTION_DEFAULTS.items():
+            if name in helper_class_kwargs and helper_class_kwargs[name] == default:
+                del helper_class_kwargs[name]
 
         def decorator(fn):
             helper = helper_class(fn, **helper_class_kwargs)
@@ -39,11 +60,14 @@ class ConfigMixin:
             def inner(*args, **kwargs):
                 return helper(*args, **kwargs)
 
+            inner.helper = helper
             inner.clear = helper.clear
             inner.get_cache_key = helper.get_cache_key
+            inner.describe_cache_key = helper.describe_cache_key
             inner.prefix = helper.prefix
             inner.get_cached_value = helper.get_cached_value
             inner.set_cached_value = helper.set_cached_value
+            inner.submit = helper.submit
 
             return inner
 
@@ -55,7 +79,18 @@ class QuickCache(namedtuple('QuickCache', [
     'cache',
     'skip_arg',
     'helper_class',
-    'assert_function'
+    'assert_function',
+    'refresh_ahead',
+    'cache_exceptions',
+    'negative_results',
+    'negative_timeout',
+    'hooks',
+    'memoize_on_instance',
+    'fingerprint',
+    'depends_on',
+    'key_format',
+    'offload',
+    'offload_timeout',
 ]), ConfigMixin):
     pass
 
@@ -65,4 +100,5 @@ get_quickcache = QuickCache(
     skip_arg=None,
     helper_class=QuickCacheHelper,
     assert_function=assert_function,
+    **HELPER_OPTION_DEFAULTS
 ).but_with
@@ -1,24 +1,185 @@
+import ast
+import base64
 import datetime
+import textwrap
+import time
 import uuid
 import hashlib
+import importlib
 import inspect
+import multiprocessing
+import pickle
+import threading
+import weakref
+from time import perf_counter
 from inspect import isfunction, getfullargspec
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError
 
+from .cache_helpers import TieredCache, _LazyThreadPool
 from .logger import logger
 from .native_utc import utc
 
 
+# vary on values that memoize_on_instance can safely compare
+MEMOIZABLE_TYPES = (str, bytes, int, float, bool, type(None), uuid.UUID,
+                    datetime.date, datetime.time, datetime.timedelta)
+
+
+class NegativeCacheEntry(namedtuple('NegativeCacheEntry', ['value', 'exception', 'expires_at'])):
+    """
+    What gets cached in place of a "not found" value or a raised exception
+
+    These carry their own (shorter) expiry,
+    which is checked when the entry is read back from the cache.
+    An exception is kept pickled, so that each read raises a fresh copy of it,
+    without the traceback (and the locals) of the call that raised it.
+    """
+
+    def unwrap(self):
+        """
+        :returns: the cached value, or ``Ellipsis`` if the entry has expired
+        :raises: the cached exception, if there is one
+        """
+        if time.time() >= self.expires_at:
+            return Ellipsis
+        if self.exception is not None:
+            try:
+                exception = pickle.loads(self.exception)
+            except Exception:
+                # e.g. the exception class changed since it was cached
+                return Ellipsis
+            raise exception
+        return self.value
+
+
+# 96 bits, which is 16 characters in base64
+COMPACT_KEY_DIGEST_SIZE = 12
+
+
+def get_fingerprint(fn, mode='source'):
+    """
+    The text that a function's cache key prefix is a hash of
+
+    In 'source' mode that's the function's source code;
+    in 'ast' mode it's a dump of its syntax tree without docstrings,
+    so that comments, docstrings and formatting don't change it.
+    """
+    source = inspect.getsource(fn)
+    if mode == 'source':
+        return source
+    elif mode == 'ast':
+        try:
+            tree = ast.parse(textwrap.dedent(source))
+        except SyntaxError:
+            # e.g. a lambda in the middle of a line
+            return source
+        for node in ast.walk(tree):
+            if isinstance(node, (ast.Module, ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)) \
+                    and ast.get_docstring(node, clean=False) is not None:
+                node.body = node.body[1:] or [ast.Pass()]
+        return ast.dump(tree)
+    else:
+        raise ValueError(f'fingerprint must be "source" or "ast", not "{mode}"')
+
+
+# how many last known values to keep per function, for offload_timeout
+STALE_VALUES_SIZE = 100
+
+_default_offload_executor = None
+_default_offload_executor_lock = threading.Lock()
+
+# offloaded results are stored in the cache from here rather than from
+# the executor's callback thread, which a process pool needs for collecting results
+_offload_store_pool = _LazyThreadPool(None, thread_name_prefix='quickcache-offload-store')
+
+
+def get_default_offload_executor():
+    """
+    The process pool shared by everything decorated with offload=True
+
+    Worker processes are started with forkserver (or spawn, where that isn't available)
+    rather than by forking, which can deadlock when other threads hold locks.
+    """
+    global _default_offload_executor
+    if _default_offload_executor is None:
+        with _default_offload_executor_lock:
+            if _default_offload_executor is None:
+                method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() \
+                    else 'spawn'
+                _default_offload_executor = ProcessPoolExecutor(
+                    mp_context=multiprocessing.get_context(method))
+    return _default_offload_executor
+
+
+def _call_in_process(module_name, qualname, args, kwargs):
+    # functions decorated with quickcache can't be pickled themselves,
+    # since the module attribute with their name is the decorated function
+    decorated = importlib.import_module(module_name)
+    for name in qualname.split('.'):
+        decorated = getattr(decorated, name)
+    # not inspect.unwrap, which would also skip any decorators under quickcache
+    return decorated.helper.fn(*args, **kwargs)
+
+
 class QuickCacheHelper:
-    def __init__(self, fn, vary_on, cache, skip_arg=None, assert_function=None):
+    def __init__(self, fn, vary_on, cache, skip_arg=None, assert_function=None,
+                 refresh_ahead=None, cache_exceptions=(), negative_results=(),
+                 negative_timeout=None, hooks=None, memoize_on_instance=False,
+                 fingerprint='source', depends_on=(), key_format='default',
+                 offload=None, offload_timeout=None):
 
         self.fn = fn
         self.cache = cache
+        self.refresh_ahead = refresh_ahead
+
+        if offload is True:
+            self._process_offload = True
+        elif offload is None or hasattr(offload, 'submit'):
+            self._process_offload = isinstance(offload, ProcessPoolExecutor)
+        else:
+            raise ValueError('offload must be None, True or an executor')
+        if self._process_offload and '<locals>' in fn.__qualname__:
+            raise ValueError(
+                f'{fn.__qualname__} cannot be offloaded to another process '
+                'because it is not defined at the top level of a module or class'
+            )
+        if offload_timeout is not None and offload is None:
+            raise ValueError(f'offload_timeout requires offload in the function: {fn.__name__}')
+        self.offload = offload
+        self.offload_timeout = offload_timeout
+        self._in_flight = {}  # cache key: Future
+        self._in_flight_lock = threading.Lock()
+        self._stale_values = OrderedDict()
+        self._stale_values_lock = threading.Lock()
+        self.hooks = hooks
+        if hooks is not None:
+            self.call = self._traced_call
+
+        if isinstance(cache_exceptions, type):
+            cache_exceptions = (cache_exceptions,)
+        if (cache_exceptions or negative_results) and not negative_timeout:
+            raise ValueError(
+                'negative_timeout is required when using cache_exceptions or negative_results '
+                f'in the function: {fn.__name__}'
+            )
+        self.cache_exceptions = tuple(cache_exceptions)
+        self.negative_results = tuple(negative_results)
+        self.negative_timeout = negative_timeout
+        fingerprint_text = get_fingerprint(fn, fingerprint)
+        for dependency in depends_on:
+            fingerprint_text += '\n' + get_fingerprint(dependency, fingerprint)
         self.prefix = '{}.{}'.format(
             fn.__name__[:40] + (fn.__name__[40:] and '..'),
-            self._hash(inspect.getsource(fn), 8)
+            self._hash(fingerprint_text, 8)
         )
 
+        if key_format not in ('default', 'compact'):
+            raise ValueError(f'key_format must be "default" or "compact", not "{key_format}"')
+        self.key_format = key_format
+        self._compact_key_hash = hashlib.blake2b(
+            self.prefix.encode('utf-8'), digest_size=COMPACT_KEY_DIGEST_SIZE)
+
         arg_names = getfullargspec(self.fn).args
         if not isfunction(vary_on):
             vary_on = [part.split('.') for part in vary_on]
@@ -54,37 +215,376 @@ class QuickCacheHelper:
                         f'as the "skip cache" parameter in the function: {self.fn.__name__}'
                     )
 
+        if memoize_on_instance and (
+                isfunction(self.vary_on) or not self.vary_on or arg_names[:1] != ['self']
+                or any(arg != 'self' for arg, attrs in self.vary_on)):
+            raise ValueError(
+                'memoize_on_instance can only be used on methods that only vary on attributes of self, '
+                f'which {self.fn.__name__} does not'
+            )
+        self.memoize_on_instance = memoize_on_instance
+        # id(instance): (vary_values, content), or None once forgotten;
+        # entries are removed when their instance is garbage collected
+        self._memos = {}
+
     def call(self, *args, **kwargs):
-        logger.debug('checking caches for %s', self.fn.__name__)
         key = self.get_cache_key(*args, **kwargs)
-        logger.debug(key)
+        if self.refresh_ahead is not None:
+            self.refresh_ahead.record(self, key, args, kwargs)
         content = self.cache.get(key, default=Ellipsis)
+        if content.__class__ is NegativeCacheEntry:
+            content = content.unwrap()
         if content is Ellipsis:
-            logger.debug('cache miss, calling %s', self.fn.__name__)
-            content = self.fn(*args, **kwargs)
-            self.cache.set(key, content)
+            content = self._compute(key, args, kwargs)
+        return content
+
+    def _traced_call(self, *args, **kwargs):
+        # replaces self.call when hooks are given, so that the untraced path
+        # doesn't pay for them
+        hooks = self.hooks
+        if not hooks.sample():
+            return type(self).call(self, *args, **kwargs)
+        start = perf_counter()
+        key = self.get_cache_key(*args, **kwargs)
+        hooks.before_lookup(self, key, perf_counter() - start)
+        try:
+            content = self._lookup(key, args, kwargs, hooks)
+            if content is Ellipsis:
+                hooks.miss(self, key)
+                content = self._compute(key, args, kwargs, hooks)
+            return content
+        finally:
+            hooks.end(self, key, perf_counter() - start)
+
+    def _lookup(self, key, args, kwargs, hooks=None):
+        # what call does before recomputing, for the paths that aren't as hot
+        if self.refresh_ahead is not None:
+            self.refresh_ahead.record(self, key, args, kwargs)
+        if hooks is None:
+            content = self.cache.get(key, default=Ellipsis)
+        else:
+            content = self._traced_get(key, hooks)
+        if content.__class__ is NegativeCacheEntry:
+            content = content.unwrap()
+        return content
+
+    def _traced_get(self, key, hooks):
+        def on_lookup(tier, hit, duration):
+            if hit:
+                hooks.tier_hit(self, key, tier, duration)
+            else:
+                hooks.tier_miss(self, key, tier, duration)
+
+        if isinstance(self.cache, TieredCache):
+            return self.cache.get(key, default=Ellipsis, on_lookup=on_lookup)
+        start = perf_counter()
+        content = self.cache.get(key, default=Ellipsis)
+        on_lookup(self.cache, content is not Ellipsis, perf_counter() - start)
         return content
 
+    def _compute(self, key, args, kwargs, hooks=None):
+        if self.offload is not None:
+            return self._compute_offloaded(key, args, kwargs, hooks)
+        try:
+            content = self._call_fn(key, args, kwargs, hooks)
+        except self.cache_exceptions as e:
+            self._store_exception(key, e, hooks)
+            raise
+        return self._store(key, content, hooks)
+
+    def _store_exception(self, key, e, hooks=None):
+        # failing to cache the exception mustn't hide it,
+        # e.g. if it can't be pickled, or if it can't be unpickled
+        # because its constructor needs more than its args
+        try:
+            pickled = pickle.dumps(e)
+            pickle.loads(pickled)
+            self._set(key, NegativeCacheEntry(
+                None, pickled, time.time() + self.negative_timeout), hooks)
+        except Exception:
+            logger.warning('quickcache could not cache %r for %s', e, key, exc_info=True)
+
+    def _is_negative_result(self, content):
+        # compared by type first, so that results with array-style __eq__
+        # (which can't be used as a bool) don't turn into errors
+        for negative_result in self.negative_results:
+            if content is negative_result:
+                return True
+            if type(content) is type(negative_result):
+                try:
+                    if content == negative_result:
+                        return True
+                except Exception:
+                    pass
+        return False
+
+    def _store(self, key, content, hooks=None):
+        if self.negative_results and self._is_negative_result(content):
+            self._set(key, NegativeCacheEntry(
+                content, None, time.time() + self.negative_timeout), hooks)
+            return content
+        self._set(key, content, hooks)
+        if self.offload_timeout is not None:
+            with self._stale_values_lock:
+                self._stale_values[key] = content
+                self._stale_values.move_to_end(key)
+                if len(self._stale_values) > STALE_VALUES_SIZE:
+                    self._stale_values.popitem(last=False)
+        if self.refresh_ahead is not None:
+            self.refresh_ahead.computed(self, key)
+        return content
+
+    def _compute_offloaded(self, key, args, kwargs, hooks):
+        if hooks is not None:
+            hooks.compute_start(self, key)
+            start = perf_counter()
+        error = None
+        try:
+            return self._wait_for(key, self._submit(key, args, kwargs))
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            if hooks is not None:
+                hooks.compute_end(self, key, perf_counter() - start, error)
+
+    def _wait_for(self, key, future):
+        if self.offload_timeout is None:
+            return future.result()
+        try:
+            return future.result(timeout=self.offload_timeout)
+        except TimeoutError:
+            with self._stale_values_lock:
+                stale = self._stale_values.get(key, Ellipsis)
+            if stale is Ellipsis:
+                return future.result()
+            return stale
+
+    def _submit(self, key, args, kwargs):
+        """
+        Recompute in the offload executor, reusing the recompute for `key` if one is already running
+
+        The returned future is resolved once the result has been stored in the cache.
+        """
+        with self._in_flight_lock:
+            result = self._in_flight.get(key)
+            if result is not None:
+                return result
+            result = self._in_flight[key] = Future()
+            # shared by everyone waiting for this key, so no one of them can cancel it
+            result.set_running_or_notify_cancel()
+        try:
+            executor = get_default_offload_executor() if self.offload is True else self.offload
+            if self._process_offload:
+                future = executor.submit(_call_in_process, self.fn.__module__, self.fn.__qualname__,
+                                         args, kwargs)
+            else:
+                future = executor.submit(self.fn, *args, **kwargs)
+        except BaseException:
+            with self._in_flight_lock:
+                del self._in_flight[key]
+            raise
+        future.add_done_callback(
+            lambda future: _offload_store_pool.get().submit(self._offload_done, key, future, result))
+        return result
+
+    def _offload_done(self, key, future, result):
+        try:
+            content = future.result()
+            self._store(key, content)
+        except BaseException as e:
+            if isinstance(e, self.cache_exceptions):
+                self._store_exception(key, e)
+            with self._in_flight_lock:
+                del self._in_flight[key]
+            result.set_exception(e)
+        else:
+            with self._in_flight_lock:
+                del self._in_flight[key]
+            result.set_result(content)
+
+    def submit(self, *args, **kwargs):
+        """
+        :returns: a Future of the value, which is recomputed in the offload executor if it isn't cached
+
+        Goes through skip_arg, memoize_on_instance, refresh_ahead and hooks like a call does,
+        except that hooks only see the lookup: the recompute isn't timed.
+        """
+        if self.offload is None:
+            raise ValueError(f'submit requires offload in the function: {self.fn.__name__}')
+        hooks = self.hooks
+        if hooks is not None and not hooks.sample():
+            hooks = None
+        start = perf_counter()
+        result = Future()
+        result.set_running_or_notify_cancel()
+        try:
+            skip = self.skip(*args, **kwargs)
+            memo = None
+            if self.memoize_on_instance:
+                if skip:
+                    self._forget_on_instance(args, kwargs)
+                else:
+                    memo = self._instance_memo(args, kwargs)
+                    stored = self._memos.get(id(memo[0])) if memo is not None else None
+                    if stored is not None and stored[0] == memo[1]:
+                        result.set_result(stored[1])
+                        return result
+            key = self.get_cache_key(*args, **kwargs)
+        except BaseException as e:
+            result.set_exception(e)
+            return result
+
+        if hooks is not None:
+            hooks.before_lookup(self, key, perf_counter() - start)
+        try:
+            content = Ellipsis if skip else self._lookup(key, args, kwargs, hooks)
+            if content is Ellipsis:
+                if hooks is not None and not skip:
+                    hooks.miss(self, key)
+                future = self._submit(key, args, kwargs)
+        except BaseException as e:
+            result.set_exception(e)
+            return result
+        finally:
+            if hooks is not None:
+                hooks.end(self, key, perf_counter() - start)
+
+        if content is not Ellipsis:
+            if memo is not None:
+                self._memoize_on_instance(*memo, content)
+            result.set_result(content)
+            return result
+        if memo is None:
+            return future
+        # resolved once the value is also memoized on the instance
+        future.add_done_callback(lambda future: self._memoize_done(memo, future, result))
+        return result
+
+    def _memoize_done(self, memo, future, result):
+        error = future.exception()
+        if error is not None:
+            result.set_exception(error)
+        else:
+            self._memoize_on_instance(*memo, future.result())
+            result.set_result(future.result())
+
+    def _call_fn(self, key, args, kwargs, hooks):
+        if hooks is None:
+            return self.fn(*args, **kwargs)
+        hooks.compute_start(self, key)
+        start = perf_counter()
+        error = None
+        try:
+            return self.fn(*args, **kwargs)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            hooks.compute_end(self, key, perf_counter() - start, error)
+
+    def _set(self, key, value, hooks):
+        if hooks is None:
+            self.cache.set(key, value)
+            return
+        start = perf_counter()
+        self.cache.set(key, value)
+        hooks.set(self, key, perf_counter() - start)
+
+    def refresh(self, key, args, kwargs):
+        """
+        Recompute and store the value for `key`, whether or not it's cached
+        """
+        return self._compute(key, args, kwargs)
+
     def get_cached_value(self, *args, **kwargs):
         """
         :returns: The cached value or ``Ellipsis``
+        :raises: the cached exception, if one was cached using ``cache_exceptions``
         """
         key = self.get_cache_key(*args, **kwargs)
-        logger.debug(key)
-        return self.cache.get(key, default=Ellipsis)
+        content = self.cache.get(key, default=Ellipsis)
+        if content.__class__ is NegativeCacheEntry:
+            content = content.unwrap()
+        return content
 
     def set_cached_value(self, *args, **kwargs):
         """
         Sets the cached value
         """
         key = self.get_cache_key(*args, **kwargs)
-        logger.debug(key)
-        return namedtuple('Settable', ['to'])(lambda value: self.cache.set(key, value))
+
+        def set_to(value):
+            self._forget_on_instance(args, kwargs)
+            self.cache.set(key, value)
+
+        return namedtuple('Settable', ['to'])(set_to)
 
     def clear(self, *args, **kwargs):
+        self._forget_on_instance(args, kwargs)
         key = self.get_cache_key(*args, **kwargs)
+        if self.offload_timeout is not None:
+            with self._stale_values_lock:
+                self._stale_values.pop(key, None)
         self.cache.delete(key)
 
+    def _instance_memo(self, args, kwargs):
+        """
+        :returns: the instance and its current vary on values,
+                  or ``None`` if the result can't be memoized for the instance
+
+        The vary on values are only remembered when they are all immutable scalars,
+        and are kept with their types, so that the memo can't be fooled by
+        an object mutated in place, or by values that are equal but key differently
+        (like 1 and True).
+        """
+        instance = args[0] if args else kwargs.get('self')
+        vary_values = []
+        try:
+            for _, attrs in self.vary_on:
+                value = instance
+                for attr in attrs:
+                    value = getattr(value, attr)
+                if not isinstance(value, MEMOIZABLE_TYPES):
+                    return None
+                vary_values.append((type(value), value))
+        except AttributeError:
+            return None
+        return instance, tuple(vary_values)
+
+    def _memoized_call(self, args, kwargs):
+        memo = self._instance_memo(args, kwargs)
+        if memo is None:
+            return self.call(*args, **kwargs)
+        instance, vary_values = memo
+        stored = self._memos.get(id(instance))
+        if stored is not None and stored[0] == vary_values:
+            return stored[1]
+        content = self.call(*args, **kwargs)
+        self._memoize_on_instance(instance, vary_values, content)
+        return content
+
+    def _memoize_on_instance(self, instance, vary_values, content):
+        instance_id = id(instance)
+        if instance_id not in self._memos:
+            try:
+                # runs before the id can be reused by another object
+                weakref.finalize(instance, self._memos.pop, instance_id, None).atexit = False
+            except TypeError:
+                # can't tell when it goes away, so don't memoize it
+                return
+        if self.negative_results and self._is_negative_result(content):
+            # these have to expire after negative_timeout, so leave them to the cache
+            self._memos[instance_id] = None
+        else:
+            self._memos[instance_id] = (vary_values, content)
+
+    def _forget_on_instance(self, args, kwargs):
+        if self.memoize_on_instance:
+            instance = args[0] if args else kwargs.get('self')
+            if id(instance) in self._memos:
+                self._memos[id(instance)] = None
+
     @staticmethod
     def _hash(value, length=32):
         return hashlib.md5(value.encode('utf-8')).hexdigest()[-length:]
@@ -135,7 +635,58 @@ class QuickCacheHelper:
         else:
             raise ValueError(f'Bad type "{type(value)}": {value}')
 
-    def get_cache_key(self, *args, **kwargs):
+    def _encode_for_key(self, value, parts):
+        """
+        Appends an unambiguous binary encoding of `value` to `parts`
+
+        Values that get the same key in the default format get the same encoding.
+        """
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+            parts.append(b'u%d:' % len(value))
+            parts.append(value)
+        elif isinstance(value, bytes):
+            try:
+                value.decode('utf-8')
+            except UnicodeDecodeError:
+                self.encoding_assert(False, 'Non-utf8 encoded string used as cache vary on')
+            parts.append(b'u%d:' % len(value))
+            parts.append(value)
+        elif isinstance(value, bool):
+            parts.append(b'b1' if value else b'b0')
+        elif isinstance(value, (int, float)):
+            value = str(value).encode('ascii')
+            parts.append(b'n%d:' % len(value))
+            parts.append(value)
+        elif isinstance(value, (list, tuple)):
+            parts.append(b'L%d:' % len(value))
+            for item in value:
+                self._encode_for_key(item, parts)
+        elif isinstance(value, (dict, set)):
+            items = value.items() if isinstance(value, dict) else value
+            encoded_items = []
+            for item in items:
+                item_parts = []
+                self._encode_for_key(item, item_parts)
+                encoded_items.append(b''.join(item_parts))
+            parts.append(b'%s%d:' % (b'D' if isinstance(value, dict) else b'S', len(value)))
+            parts.extend(sorted(encoded_items))
+        elif isinstance(value, uuid.UUID):
+            parts.append(b'U')
+            parts.append(value.bytes)
+        elif isinstance(value, datetime.datetime):
+            # see _serialize_for_key
+            if value.tzinfo:
+                value = value.astimezone(utc)
+            value = value.isoformat().encode('ascii')
+            parts.append(b'T%d:' % len(value))
+            parts.append(value)
+        elif value is None:
+            parts.append(b'N')
+        else:
+            raise ValueError(f'Bad type "{type(value)}": {value}')
+
+    def _get_vary_values(self, args, kwargs):
         callargs = inspect.getcallargs(self.fn, *args, **kwargs)
         values = []
         if isfunction(self.vary_on):
@@ -146,12 +697,38 @@ class QuickCacheHelper:
                 for attr in attrs:
                     value = getattr(value, attr)
                 values.append(value)
+        return values
+
+    def get_cache_key(self, *args, **kwargs):
+        values = self._get_vary_values(args, kwargs)
+        if self.key_format == 'compact':
+            return self._get_compact_cache_key(values)
+        return self._get_default_cache_key(values)
+
+    def _get_default_cache_key(self, values):
         args_string = ','.join(self._serialize_for_key(value)
                                for value in values)
         if len(args_string) > 150:
             args_string = 'H' + self._hash(args_string)
         return f'quickcache.{self.prefix}/{args_string}'
 
+    def _get_compact_cache_key(self, values):
+        parts = []
+        for value in values:
+            self._encode_for_key(value, parts)
+        key_hash = self._compact_key_hash.copy()
+        key_hash.update(b''.join(parts))
+        return 'qc.' + base64.urlsafe_b64encode(key_hash.digest()).decode('ascii')
+
+    def describe_cache_key(self, *args, **kwargs):
+        """
+        :returns: the (compact) cache key along with the human readable default format key
+
+        Meant for debugging, when using key_format='compact'
+        """
+        values = self._get_vary_values(args, kwargs)
+        return self._get_compact_cache_key(values), self._get_default_cache_key(values)
+
     def skip(self, *args, **kwargs):
         if not self.skip_arg:
             return False
@@ -166,9 +743,30 @@ class QuickCacheHelper:
 
     def __call__(self, *args, **kwargs):
         if not self.skip(*args, **kwargs):
+            if self.memoize_on_instance:
+                return self._memoized_call(args, kwargs)
             return self.call(*args, **kwargs)
         else:
-            content = self.fn(*args, **kwargs)
-            key = self.get_cache_key(*args, **kwargs)
-            self.cache.set(key, content)
+            return self._recompute(args, kwargs)
+
+    def _recompute(self, args, kwargs):
+        # called instead of self.call when skip_arg says to skip the cache
+        hooks = self.hooks
+        if hooks is not None and not hooks.sample():
+            hooks = None
+        start = perf_counter()
+        key = self.get_cache_key(*args, **kwargs)
+        if hooks is not None:
+            hooks.before_lookup(self, key, perf_counter() - start)
+        try:
+            if self.memoize_on_instance:
+                self._forget_on_instance(args, kwargs)
+            content = self._compute(key, args, kwargs, hooks)
+            if self.memoize_on_instance:
+                memo = self._instance_memo(args, kwargs)
+                if memo is not None:
+                    self._memoize_on_instance(*memo, content)
             return content
+        finally:
+            if hooks is not None:
+                hooks.end(self, key, perf_counter() - start)
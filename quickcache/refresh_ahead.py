@@ -0,0 +1,283 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .logger import logger
+
+
+class _Bucket:
+    __slots__ = ('count', 'keys', 'prev', 'next')
+
+    def __init__(self, count, prev, next):
+        self.count = count
+        self.keys = {}  # key: payload, used as an ordered set
+        self.prev = prev
+        self.next = next
+
+
+class HeavyHitters:
+    """
+    Space-Saving sketch of the most frequent keys
+
+    Keeps approximate counts for at most `capacity` keys,
+    along with a payload for each of them.
+    When the sketch is full, the least counted key is replaced
+    and the new key inherits its count, so a key that is really frequent
+    can't be pushed out by a stream of rare keys.
+
+    Keys are kept in a "stream summary": a linked list of buckets of keys
+    with the same count, in increasing order of count,
+    so that adding a key is O(1).
+
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._buckets = {}  # key: _Bucket
+        self._head = None  # lowest count
+        self._tail = None  # highest count
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def _unlink(self, bucket):
+        if bucket.prev is None:
+            self._head = bucket.next
+        else:
+            bucket.prev.next = bucket.next
+        if bucket.next is None:
+            self._tail = bucket.prev
+        else:
+            bucket.next.prev = bucket.prev
+
+    def _bucket_after(self, bucket, count):
+        # the bucket for `count`, which goes right after `bucket` (or first, if bucket is None)
+        following = self._head if bucket is None else bucket.next
+        if following is not None and following.count == count:
+            return following
+        new_bucket = _Bucket(count, bucket, following)
+        if bucket is None:
+            self._head = new_bucket
+        else:
+            bucket.next = new_bucket
+        if following is None:
+            self._tail = new_bucket
+        else:
+            following.prev = new_bucket
+        return new_bucket
+
+    def _move(self, key, payload, bucket, count):
+        # move key from bucket (or nowhere) to the bucket for `count`
+        new_bucket = self._bucket_after(bucket, count)
+        if bucket is not None:
+            del bucket.keys[key]
+            if not bucket.keys:
+                self._unlink(bucket)
+        new_bucket.keys[key] = payload
+        self._buckets[key] = new_bucket
+
+    def add(self, key, payload):
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            self._move(key, payload, bucket, bucket.count + 1)
+        elif len(self._buckets) < self.capacity:
+            self._move(key, payload, None, 1)
+        else:
+            bucket = self._head
+            victim = next(iter(bucket.keys))
+            del self._buckets[victim]
+            # take the victim's place, then count this occurrence
+            bucket.keys[key] = bucket.keys.pop(victim)
+            self._move(key, payload, bucket, bucket.count + 1)
+
+    def get(self, key):
+        bucket = self._buckets.get(key)
+        return bucket.keys[key] if bucket is not None else None
+
+    def count(self, key):
+        bucket = self._buckets.get(key)
+        return bucket.count if bucket is not None else 0
+
+    def top(self, k):
+        """
+        :returns: a list of (key, payload) for the k most frequent keys
+        """
+        result = []
+        bucket = self._tail
+        while bucket is not None and len(result) < k:
+            result.extend(list(bucket.keys.items())[:k - len(result)])
+            bucket = bucket.prev
+        return result
+
+
+class _HotEntry:
+    """
+    What RefreshAhead remembers about a key
+    """
+    __slots__ = ('args', 'kwargs', 'last_seen', 'computed_at')
+
+    def __init__(self, args, kwargs, last_seen):
+        self.args = args
+        self.kwargs = kwargs
+        self.last_seen = last_seen
+        self.computed_at = None
+
+
+class _FunctionStats:
+    __slots__ = ('lock', 'sketch')
+
+    def __init__(self, capacity):
+        self.lock = threading.Lock()
+        self.sketch = HeavyHitters(capacity)
+
+
+class RefreshAhead:
+    """
+    Recomputes the most popular cache entries shortly before they expire
+
+    Pass an instance as the `refresh_ahead` argument of the decorator.
+    Every call is counted in a HeavyHitters sketch per function, which also
+    remembers the arguments of the latest call for each of the keys it tracks.
+    These are kept alive for as long as the key is tracked,
+    which is for at most `capacity` keys per function.
+    Every `interval` seconds a background thread looks at the `top_k` keys
+    of each function and recomputes those that expire within `lead_time`
+    seconds, assuming entries live for `timeout` seconds after being computed.
+
+    Only keys that have been requested since they were last computed are refreshed,
+    so a key that stops getting traffic is left to expire.
+
+    At most `max_workers` refreshes run at a time, and refreshes are skipped
+    once they've used more than `cpu_budget` (a fraction of one core)
+    of CPU time.
+
+    """
+
+    def __init__(self, timeout, lead_time=None, top_k=10, capacity=None,
+                 max_workers=2, cpu_budget=0.25, interval=None, autostart=True):
+        self.timeout = timeout
+        self.lead_time = timeout / 10 if lead_time is None else lead_time
+        self.top_k = top_k
+        self.capacity = capacity or top_k * 10
+        self.max_workers = max_workers
+        self.cpu_budget = cpu_budget
+        self.interval = self.lead_time / 2 if interval is None else interval
+        self.autostart = autostart
+
+        # guards _stats being added to, and the scheduling state below;
+        # each function's sketch has its own lock
+        self._lock = threading.Lock()
+        self._stats = {}  # helper: _FunctionStats
+        self._in_flight = set()
+        self._budget = self._max_budget
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix='quickcache-refresh')
+        self._thread = None
+        self._stopped = threading.Event()
+
+    @property
+    def _max_budget(self):
+        return self.cpu_budget * self.interval
+
+    def _get_stats(self, helper):
+        stats = self._stats.get(helper)
+        if stats is None:
+            with self._lock:
+                stats = self._stats.setdefault(helper, _FunctionStats(self.capacity))
+        return stats
+
+    def record(self, helper, key, args, kwargs):
+        """
+        Count a lookup of `key` by `helper`
+        """
+        now = time.time()
+        stats = self._get_stats(helper)
+        with stats.lock:
+            entry = stats.sketch.get(key)
+            if entry is None:
+                entry = _HotEntry(args, kwargs, now)
+            else:
+                entry.last_seen = now
+                entry.args = args
+                entry.kwargs = kwargs
+            stats.sketch.add(key, entry)
+        if self.autostart and self._thread is None:
+            self.start()
+
+    def computed(self, helper, key):
+        """
+        Note that the value for `key` was just computed and stored
+        """
+        stats = self._stats.get(helper)
+        if stats is None:
+            return
+        now = time.time()
+        with stats.lock:
+            entry = stats.sketch.get(key)
+            if entry is not None:
+                entry.computed_at = now
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='quickcache-refresh-ahead',
+                                            daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.tick()
+            except Exception:
+                logger.exception('quickcache refresh-ahead tick failed')
+
+    def tick(self):
+        """
+        Schedule refreshes of the hot keys that are about to expire
+
+        :returns: a list of futures for the refreshes scheduled
+        """
+        now = time.time()
+        candidates = []
+        for helper, stats in list(self._stats.items()):
+            with stats.lock:
+                top = stats.sketch.top(self.top_k)
+                for key, entry in top:
+                    if entry.computed_at is None:
+                        continue
+                    if entry.last_seen <= entry.computed_at:
+                        # nobody asked for it since it was computed
+                        continue
+                    expires_at = entry.computed_at + self.timeout
+                    if now >= expires_at - self.lead_time:
+                        candidates.append((expires_at, helper, key, entry))
+        candidates.sort(key=lambda candidate: candidate[0])
+
+        futures = []
+        with self._lock:
+            self._budget = min(self._budget + self._max_budget, self._max_budget)
+            for _, helper, key, entry in candidates:
+                if len(self._in_flight) >= self.max_workers or self._budget <= 0:
+                    break
+                if key in self._in_flight:
+                    continue
+                self._in_flight.add(key)
+                futures.append(self._executor.submit(self._refresh, helper, key,
+                                                     entry.args, entry.kwargs))
+        return futures
+
+    def _refresh(self, helper, key, args, kwargs):
+        start = time.thread_time()
+        try:
+            helper.refresh(key, args, kwargs)
+        except Exception:
+            logger.exception('quickcache failed to refresh %s', key)
+        finally:
+            spent = time.thread_time() - start
+            with self._lock:
+                self._budget -= spent
+                self._in_flight.discard(key)
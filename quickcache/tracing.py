@@ -0,0 +1,154 @@
+import itertools
+import threading
+
+from .logger import logger
+
+
+class CacheHooks:
+    """
+    Receives events from the quickcache hot path
+
+    Pass an instance as the `hooks` argument of the decorator,
+    and override the events you're interested in.
+    Durations are in seconds, as measured with `time.perf_counter`.
+
+    `sample` is called once per call to decide whether that call is traced;
+    when no hooks are given the hot path doesn't check for them at all.
+
+    """
+
+    def sample(self):
+        return True
+
+    def before_lookup(self, helper, key, duration):
+        """
+        The cache key was built in `duration`, and is about to be looked up
+
+        Called at the start of every traced call, including those where
+        skip_arg skips the lookup and goes straight to recomputing.
+        """
+
+    def tier_hit(self, helper, key, tier, duration):
+        """`tier` had the value"""
+
+    def tier_miss(self, helper, key, tier, duration):
+        """`tier` didn't have the value"""
+
+    def miss(self, helper, key):
+        """None of the caches had the value"""
+
+    def compute_start(self, helper, key):
+        """The decorated function is about to be called"""
+
+    def compute_end(self, helper, key, duration, error):
+        """The decorated function returned, or raised `error`"""
+
+    def set(self, helper, key, duration):
+        """The value was stored in the cache"""
+
+    def end(self, helper, key, duration):
+        """The whole call took `duration`"""
+
+
+class SampledHooks:
+    """
+    Only passes one in `every` calls on to `hooks`
+    """
+
+    def __init__(self, hooks, every):
+        self.hooks = hooks
+        self.every = every
+        self._counter = itertools.count()
+
+    def sample(self):
+        return next(self._counter) % self.every == 0 and self.hooks.sample()
+
+    def __getattr__(self, name):
+        return getattr(self.hooks, name)
+
+
+class LoggingHooks(CacheHooks):
+    """
+    Logs each lookup and miss at debug level
+    """
+
+    def before_lookup(self, helper, key, duration):
+        logger.debug('checking caches for %s', helper.fn.__name__)
+        logger.debug(key)
+
+    def tier_hit(self, helper, key, tier, duration):
+        logger.debug('hit cache: %s', tier.__class__.__name__)
+
+    def miss(self, helper, key):
+        logger.debug('cache miss, calling %s', helper.fn.__name__)
+
+
+class ProfilerHooks(CacheHooks):
+    """
+    Collects cProfile-style call counts and times for each stage of a call
+
+    The stages are 'key', one 'tier:<n>' per cache tier, 'compute', 'set' and 'call',
+    collected per function in `stats` as {(function name, stage): [ncalls, tottime]}.
+
+    If `profile` is a `cProfile.Profile`, it is enabled while the decorated
+    function is recomputed, so that `pstats.Stats(profile)` shows where
+    the time in (sampled) recomputes goes.
+    Only one thread is profiled at a time.
+
+    """
+
+    def __init__(self, profile=None):
+        self.profile = profile
+        self.stats = {}
+        self._lock = threading.Lock()
+        self._profile_lock = threading.Lock()
+        self._local = threading.local()
+
+    def _add(self, helper, stage, duration):
+        with self._lock:
+            entry = self.stats.setdefault((helper.fn.__name__, stage), [0, 0.0])
+            entry[0] += 1
+            entry[1] += duration
+
+    def before_lookup(self, helper, key, duration):
+        self._local.tier = 0
+        self._add(helper, 'key', duration)
+
+    def _tier(self, helper, duration):
+        tier = getattr(self._local, 'tier', 0)
+        self._local.tier = tier + 1
+        self._add(helper, f'tier:{tier}', duration)
+
+    def tier_hit(self, helper, key, tier, duration):
+        self._tier(helper, duration)
+
+    def tier_miss(self, helper, key, tier, duration):
+        self._tier(helper, duration)
+
+    def compute_start(self, helper, key):
+        if self.profile is not None and not getattr(self._local, 'profiling', False):
+            if self._profile_lock.acquire(blocking=False):
+                self._local.profiling = True
+                self._local.profiling_key = key
+                self.profile.enable()
+
+    def compute_end(self, helper, key, duration, error):
+        if getattr(self._local, 'profiling', False) and self._local.profiling_key == key:
+            self.profile.disable()
+            self._local.profiling = False
+            self._profile_lock.release()
+        self._add(helper, 'compute', duration)
+
+    def set(self, helper, key, duration):
+        self._add(helper, 'set', duration)
+
+    def end(self, helper, key, duration):
+        self._add(helper, 'call', duration)
+
+    def print_stats(self, stream=None):
+        lines = ['   ncalls  tottime  percall  function:stage']
+        with self._lock:
+            stats = sorted(self.stats.items(), key=lambda item: -item[1][1])
+        for (name, stage), (ncalls, tottime) in stats:
+            lines.append(f'{ncalls:9d} {tottime:8.3f} {tottime / ncalls:8.3f}  {name}:{stage}')
+        print('\n'.join(lines), file=stream)
@@ -11,6 +11,9 @@ setup(
     packages=['quickcache'],
     test_suite='test_quickcache',
     install_requires=[],
+    extras_require={
+        'opentelemetry': ['opentelemetry-api'],
+    },
     classifiers=[
         'Programming Language :: Python',
         'Programming Language :: Python :: 3',
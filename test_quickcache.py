@@ -1,14 +1,27 @@
 # -*- coding: utf-8 -*-
+import os
+import pickle
+import random
+import threading
 import time
+import traceback
 
+from concurrent.futures import ThreadPoolExecutor
 from unittest import TestCase
+import copy
 import datetime
+import functools
 
 import uuid
 
-from quickcache import get_quickcache
-from quickcache.cache_helpers import TieredCache, CacheWithPresets, CacheWithTimeout
+from unittest import mock
+
+from quickcache import get_quickcache, ForceSkipCache, QuickCacheHelper
+from quickcache.cache_helpers import TieredCache, CacheWithPresets, CacheWithTimeout, ShardedCache
 from quickcache.native_utc import utc
+from quickcache.quickcache_helper import NegativeCacheEntry
+from quickcache.refresh_ahead import HeavyHitters, RefreshAhead
+from quickcache.tracing import CacheHooks, ProfilerHooks, SampledHooks
 
 BUFFER = []
 
@@ -29,7 +42,7 @@ class LocMemCache(object):
         if datetime.datetime.utcnow() < expire_time:
             return value
         else:
-            del self._cache[key]
+            self._cache.pop(key, None)
             return default
 
     def set(self, key, value, timeout=None):
@@ -37,6 +50,9 @@ class LocMemCache(object):
                                         if timeout is None else timeout)
         self._cache[key] = (datetime.datetime.utcnow() + timeout_td, value)
 
+    def delete(self, key):
+        self._cache.pop(key, None)
+
 
 class CacheMock(LocMemCache):
 
@@ -58,6 +74,100 @@ class CacheMock(LocMemCache):
             BUFFER.append('{} set'.format(self.name))
 
 
+class PicklingCache(CacheMock):
+    """Pickles values, like shared caches (and Django's locmem cache) do"""
+
+    def get(self, key, default=None):
+        result = super(PicklingCache, self).get(key, Ellipsis)
+        return default if result is Ellipsis else pickle.loads(result)
+
+    def set(self, key, value, timeout=None):
+        super(PicklingCache, self).set(key, pickle.dumps(value), timeout)
+
+
+class NotFound(Exception):
+    def __init__(self, message, *, status):
+        super(NotFound, self).__init__(message)
+        self.status = status
+
+
+class BrokenCache(object):
+
+    def get(self, key, default=None):
+        raise ConnectionError('shard down')
+
+    def set(self, key, value, timeout=None):
+        raise ConnectionError('shard down')
+
+    def delete(self, key):
+        raise ConnectionError('shard down')
+
+
+class SlowCache(LocMemCache):
+
+    def __init__(self, name, timeout, delay):
+        self.delay = delay
+        super(SlowCache, self).__init__(name, timeout=timeout)
+
+    def get(self, key, default=None):
+        time.sleep(self.delay)
+        return super(SlowCache, self).get(key, default)
+
+
+class BlockingCache(LocMemCache):
+    """Pauses every get until `release` is set, after reading the value"""
+
+    def __init__(self, name, timeout):
+        self.reading = threading.Event()
+        self.release = threading.Event()
+        super(BlockingCache, self).__init__(name, timeout=timeout)
+
+    def get(self, key, default=None):
+        result = super(BlockingCache, self).get(key, default)
+        self.reading.set()
+        self.release.wait()
+        return result
+
+
+class RecordingHooks(CacheHooks):
+
+    def before_lookup(self, helper, key, duration):
+        BUFFER.append('before lookup')
+
+    def tier_hit(self, helper, key, tier, duration):
+        BUFFER.append('{} hit hook'.format(tier.name))
+
+    def tier_miss(self, helper, key, tier, duration):
+        BUFFER.append('{} miss hook'.format(tier.name))
+
+    def miss(self, helper, key):
+        BUFFER.append('miss')
+
+    def compute_start(self, helper, key):
+        BUFFER.append('compute start')
+
+    def compute_end(self, helper, key, duration, error):
+        BUFFER.append('compute end {!r}'.format(error))
+
+    def set(self, helper, key, duration):
+        BUFFER.append('set')
+
+    def end(self, helper, key, duration):
+        BUFFER.append('end')
+
+
+class SkippedCache(object):
+
+    def get(self, key, default=None):
+        raise ForceSkipCache()
+
+    def set(self, key, value, timeout=None):
+        raise ForceSkipCache()
+
+    def delete(self, key):
+        raise ForceSkipCache()
+
+
 class SessionMock(object):
     session = ''
 
@@ -96,6 +206,24 @@ quickcache = get_quickcache(cache=TieredCache([
 ))
 
 
+@quickcache(['n'], offload=True)
+def square_in_process(n):
+    return os.getpid(), n * n
+
+
+def tag_result(fn):
+    @functools.wraps(fn)
+    def wrapper(n):
+        return 'wrapped', fn(n)
+    return wrapper
+
+
+@quickcache(['n'], offload=True)
+@tag_result
+def tagged_in_process(n):
+    return n
+
+
 class QuickcacheTest(TestCase):
 
     def tearDown(self):
@@ -224,7 +352,7 @@ class QuickcacheTest(TestCase):
         self.assertEqual(self.consume_buffer(), ['local hit'])
 
     def test_bad_vary_on(self):
-        with self.assertRaisesRegexp(ValueError, 'cucumber'):
+        with self.assertRaisesRegex(ValueError, 'cucumber'):
             @quickcache(['cucumber'], cache=_cache)
             def square(number):
                 return number * number
@@ -274,7 +402,7 @@ class QuickcacheTest(TestCase):
             pass
 
         key = cached_fn.get_cache_key({'name': 'a1'})
-        self.assertRegexpMatches(key, 'quickcache.cached_fn.[a-z0-9]{8}/u[a-z0-9]{32}')
+        self.assertRegex(key, 'quickcache.cached_fn.[a-z0-9]{8}/u[a-z0-9]{32}')
 
     def test_unicode_string(self):
         @quickcache(['name'], cache=_cache)
@@ -443,3 +571,1039 @@ class QuickcacheTest(TestCase):
         return_name.set_cached_value(name).to('NEW VALUE')
         self.assertEqual(return_name(name), 'NEW VALUE')
         self.assertEqual(self.consume_buffer(), ['local hit'])
+
+    def test_cache_exceptions(self):
+        cache = CacheMock('cache', timeout=10 * SHORT_TIME_UNIT, silent_set=False)
+
+        @quickcache(['name'], cache=cache, skip_arg='force',
+                    cache_exceptions=LookupError, negative_timeout=SHORT_TIME_UNIT)
+        def by_name(name, force=False):
+            BUFFER.append('called')
+            raise KeyError(name)
+
+        with self.assertRaisesRegex(KeyError, 'name'):
+            by_name('name')
+        self.assertEqual(self.consume_buffer(), ['cache miss', 'called', 'cache set'])
+        with self.assertRaisesRegex(KeyError, 'name'):
+            by_name('name')
+        self.assertEqual(self.consume_buffer(), ['cache hit'])
+
+        # skip_arg bypasses the cached exception
+        with self.assertRaises(KeyError):
+            by_name('name', force=True)
+        self.assertEqual(self.consume_buffer(), ['called', 'cache set'])
+
+        # clear clears it
+        by_name.clear('name')
+        with self.assertRaises(KeyError):
+            by_name('name')
+        self.assertEqual(self.consume_buffer(), ['cache miss', 'called', 'cache set'])
+
+        # negative_timeout is independent of the cache's own timeout
+        time.sleep(SHORT_TIME_UNIT)
+        with self.assertRaises(KeyError):
+            by_name('name')
+        self.assertEqual(self.consume_buffer(), ['cache hit', 'called', 'cache set'])
+
+    def test_cached_exception_is_a_fresh_copy(self):
+        cache = PicklingCache('cache', timeout=60)
+
+        @quickcache(['name'], cache=cache, cache_exceptions=[KeyError], negative_timeout=60)
+        def by_name(name):
+            BUFFER.append('called')
+            raise KeyError(name)
+
+        raised = []
+        for _ in range(3):
+            with self.assertRaises(KeyError) as context:
+                by_name('name')
+            raised.append(context.exception)
+        self.assertEqual(self.consume_buffer(), ['cache miss', 'called', 'cache hit', 'cache hit'])
+        self.assertIsNot(raised[1], raised[2])
+        # raised from the cache, not from the call that originally raised it
+        self.assertNotIn('by_name', [frame.name for frame in traceback.extract_tb(raised[1].__traceback__)])
+
+        # an exception that can no longer be unpickled is treated as a miss
+        entry = NegativeCacheEntry(None, b'not a pickle', time.time() + 60)
+        self.assertEqual(entry.unwrap(), Ellipsis)
+
+    def test_cache_exception_without_args_constructor(self):
+        # pickles, but can't be unpickled, so isn't cached
+        cache = PicklingCache('cache', timeout=60)
+
+        @quickcache(['name'], cache=cache, cache_exceptions=NotFound, negative_timeout=60)
+        def by_name(name):
+            BUFFER.append('called')
+            raise NotFound(name, status=404)
+
+        with mock.patch('quickcache.quickcache_helper.logger') as logger:
+            for _ in range(2):
+                with self.assertRaises(NotFound) as context:
+                    by_name('name')
+                self.assertEqual(context.exception.status, 404)
+        self.assertTrue(logger.warning.called)
+        self.assertEqual(self.consume_buffer(), ['cache miss', 'called', 'cache miss', 'called'])
+
+    def test_cache_exception_that_cannot_be_stored(self):
+        class UnpicklableCache(LocMemCache):
+            def set(self, key, value, timeout=None):
+                raise TypeError('cannot pickle')
+
+        @quickcache(['name'], cache=UnpicklableCache('cache', timeout=60),
+                    cache_exceptions=KeyError, negative_timeout=60)
+        def by_name(name):
+            raise KeyError(name)
+
+        with self.assertRaises(KeyError):
+            by_name('name')
+
+    def test_uncached_exceptions(self):
+        @quickcache(['name'], cache=_cache_with_set,
+                    cache_exceptions=KeyError, negative_timeout=SHORT_TIME_UNIT)
+        def by_name(name):
+            BUFFER.append('called')
+            raise ValueError(name)
+
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                by_name('name')
+            self.assertEqual(self.consume_buffer(), ['cache miss', 'called'])
+
+    def test_negative_results_with_array_style_eq(self):
+        class Frame(object):
+            def __eq__(self, other):
+                return self
+
+            def __bool__(self):
+                raise ValueError('The truth value of a Frame is ambiguous')
+
+        cache = CacheMock('cache', timeout=60)
+
+        @quickcache([], cache=cache, negative_results=[None], negative_timeout=60)
+        def get_frame():
+            return Frame()
+
+        self.assertIsInstance(get_frame(), Frame)
+        self.assertIsInstance(get_frame(), Frame)
+        self.assertEqual(self.consume_buffer(), ['cache miss', 'cache hit'])
+
+    def test_negative_results(self):
+        cache = CacheMock('cache', timeout=10 * SHORT_TIME_UNIT, silent_set=False)
+
+        @quickcache(['name'], cache=cache,
+                    negative_results=[None], negative_timeout=SHORT_TIME_UNIT)
+        def by_name(name):
+            BUFFER.append('called')
+            return None if name == 'missing' else name
+
+        self.assertIsNone(by_name('missing'))
+        self.assertEqual(self.consume_buffer(), ['cache miss', 'called', 'cache set'])
+        self.assertIsNone(by_name('missing'))
+        self.assertEqual(self.consume_buffer(), ['cache hit'])
+        self.assertIsNone(by_name.get_cached_value('missing'))
+        self.assertEqual(self.consume_buffer(), ['cache hit'])
+
+        time.sleep(SHORT_TIME_UNIT)
+        self.assertEqual(by_name.get_cached_value('missing'), Ellipsis)
+        self.assertIsNone(by_name('missing'))
+        self.assertEqual(self.consume_buffer(), ['cache hit', 'cache hit', 'called', 'cache set'])
+
+        # other values are cached as usual
+        self.assertEqual(by_name('name'), 'name')
+        time.sleep(SHORT_TIME_UNIT)
+        self.assertEqual(by_name('name'), 'name')
+        self.assertEqual(self.consume_buffer(), ['cache miss', 'called', 'cache set', 'cache hit'])
+
+    def test_negative_timeout_required(self):
+        with self.assertRaises(ValueError):
+            @quickcache(['name'], cache_exceptions=KeyError)
+            def by_name(name):
+                pass
+
+    def test_memoize_on_instance(self):
+        cache = CacheMock('cache', timeout=60, silent_set=False)
+
+        class Item(object):
+
+            def __init__(self, id, name):
+                self.id = id
+                self.name = name
+
+            @quickcache(['self.id'], cache=cache, memoize_on_instance=True)
+            def get_name(self):
+                BUFFER.append('called')
+                return self.name
+
+        james = Item(1, 'james')
+        self.assertEqual(james.get_name(), 'james')
+        self.assertEqual(self.consume_buffer(), ['cache miss', 'called', 'cache set'])
+        # doesn't even look in the cache
+        self.assertEqual(james.get_name(), 'james')
+        self.assertEqual(self.consume_buffer(), [])
+
+        # other instances with the same id share the cache, but not the memo
+        self.assertEqual(Item(1, 'james').get_name(), 'james')
+        self.assertEqual(self.consume_buffer(), ['cache hit'])
+
+        # changing the vary on attributes misses the memo
+        james.id = 2
+        self.assertEqual(james.get_name(), 'james')
+        self.assertEqual(self.consume_buffer(), ['cache miss', 'called', 'cache set'])
+
+        Item.get_name.clear(james)
+        self.assertEqual(james.get_name(), 'james')
+        self.assertEqual(self.consume_buffer(), ['cache miss', 'called', 'cache set'])
+
+        Item.get_name.set_cached_value(james).to('jim')
+        self.assertEqual(james.get_name(), 'jim')
+        self.assertEqual(self.consume_buffer(), ['cache set', 'cache hit'])
+        self.assertEqual(james.get_name(), 'jim')
+        self.assertEqual(self.consume_buffer(), [])
+
+    def test_memoize_on_instance_is_not_copied(self):
+        cache = CacheMock('cache', timeout=60)
+
+        class Item(object):
+
+            def __init__(self, id):
+                self.id = id
+
+            @quickcache(['self.id'], cache=cache, memoize_on_instance=True)
+            def get_id(self):
+                BUFFER.append('called')
+                return self.id
+
+        class SlottedItem(object):
+            __slots__ = ('id',)
+
+            def __init__(self, id):
+                self.id = id
+
+            @quickcache(['self.id'], cache=cache, memoize_on_instance=True)
+            def get_id(self):
+                BUFFER.append('called')
+                return self.id
+
+        item = Item(1)
+        self.assertEqual(item.get_id(), 1)
+        self.assertEqual(vars(item), {'id': 1})
+        self.assertEqual(self.consume_buffer(), ['cache miss', 'called'])
+
+        # a copy (or an unpickled instance) looks in the cache, so it sees clear()
+        Item.get_id.clear(item)
+        self.assertEqual(copy.copy(item).get_id(), 1)
+        self.assertEqual(self.consume_buffer(), ['cache miss', 'called'])
+        self.assertEqual(item.get_id(), 1)
+        self.assertEqual(self.consume_buffer(), ['cache hit'])
+
+        # instances that can't be weakly referenced aren't memoized
+        slotted = SlottedItem(2)
+        for _ in range(2):
+            self.assertEqual(slotted.get_id(), 2)
+        self.assertEqual(self.consume_buffer(), ['cache miss', 'called', 'cache hit'])
+
+    def test_memoize_on_instance_mutable_vary_on(self):
+        cache = CacheMock('cache', timeout=60, silent_set=False)
+
+        class Item(object):
+
+            def __init__(self, tags):
+                self.tags = tags
+
+            @quickcache(['self.tags'], cache=cache, memoize_on_instance=True)
+            def count_tags(self):
+                BUFFER.append('called')
+                return len(self.tags)
+
+        item = Item(['a'])
+        self.assertEqual(item.count_tags(), 1)
+        self.assertEqual(self.consume_buffer(), ['cache miss', 'called', 'cache set'])
+        # lists aren't memoized on the instance, so mutating one in place is noticed
+        item.tags.append('b')
+        self.assertEqual(item.count_tags(), 2)
+        self.assertEqual(self.consume_buffer(), ['cache miss', 'called', 'cache set'])
+        self.assertEqual(item.count_tags(), 2)
+        self.assertEqual(self.consume_buffer(), ['cache hit'])
+
+    def test_memoize_on_instance_compares_types(self):
+        cache = CacheMock('cache', timeout=60, silent_set=False)
+
+        class Item(object):
+
+            def __init__(self, id):
+                self.id = id
+
+            @quickcache(['self.id'], cache=cache, memoize_on_instance=True)
+            def describe(self):
+                BUFFER.append('called')
+                return repr(self.id)
+
+        item = Item(1)
+        self.assertEqual(item.describe(), '1')
+        self.assertEqual(self.consume_buffer(), ['cache miss', 'called', 'cache set'])
+        # 1 == True, but they're different cache keys
+        item.id = True
+        self.assertEqual(item.describe(), 'True')
+        self.assertEqual(self.consume_buffer(), ['cache miss', 'called', 'cache set'])
+        self.assertEqual(item.describe(), 'True')
+        self.assertEqual(self.consume_buffer(), [])
+
+    def test_memoize_on_instance_validation(self):
+        with self.assertRaises(ValueError):
+            @quickcache(['name'], memoize_on_instance=True)
+            def by_name(name):
+                pass
+
+        with self.assertRaises(ValueError):
+            class Item(object):
+                @quickcache(['self.id', 'name'], memoize_on_instance=True)
+                def by_name(self, name):
+                    pass
+
+    def test_ast_fingerprint(self):
+        def original(fingerprint):
+            @quickcache([], fingerprint=fingerprint)
+            def get_value():
+                return 1 + 1
+            return get_value
+
+        def reformatted(fingerprint):
+            @quickcache([], fingerprint=fingerprint)
+            def get_value():
+                """Now with a docstring"""
+                # and a comment
+                return (
+                    1 + 1
+                )
+            return get_value
+
+        def changed(fingerprint):
+            @quickcache([], fingerprint=fingerprint)
+            def get_value():
+                return 1 + 2
+            return get_value
+
+        self.assertNotEqual(original('source').prefix, reformatted('source').prefix)
+        self.assertEqual(original('ast').prefix, reformatted('ast').prefix)
+        self.assertNotEqual(original('ast').prefix, changed('ast').prefix)
+
+        with self.assertRaises(ValueError):
+            original('bytecode')
+
+    def test_fingerprint_depends_on(self):
+        def dependency_v1():
+            def dependency():
+                return 1
+            return dependency
+
+        def dependency_v1_with_comment():
+            def dependency():
+                # a comment
+                return 1
+            return dependency
+
+        def dependency_v2():
+            def dependency():
+                return 2
+            return dependency
+
+        def get_value(depends_on):
+            @quickcache([], fingerprint='ast', depends_on=depends_on)
+            def get_value():
+                pass
+            return get_value
+
+        v1 = get_value([dependency_v1()]).prefix
+        self.assertNotEqual(get_value([]).prefix, v1)
+        self.assertEqual(get_value([dependency_v1_with_comment()]).prefix, v1)
+        self.assertNotEqual(get_value([dependency_v2()]).prefix, v1)
+
+    def test_compact_key(self):
+        @quickcache(['value'], key_format='compact')
+        def by_value(value):
+            return uuid.uuid4().hex
+
+        key = by_value.get_cache_key('name')
+        self.assertRegex(key, r'^qc\.[A-Za-z0-9_-]{16}$')
+        self.assertEqual(len(by_value.get_cache_key('x' * 1000)), len(key))
+
+        dt = datetime.datetime(2018, 3, 30, tzinfo=utc)
+        same_keys = [
+            ('namé', 'namé'.encode('utf-8')),
+            ({'a': 1, 'b': [1, 2]}, {'b': [1, 2], 'a': 1}),
+            ({1, 2, 3}, {3, 2, 1}),
+            (dt, dt.astimezone(CustomTZ())),
+        ]
+        for value, other_value in same_keys:
+            self.assertEqual(by_value.get_cache_key(value), by_value.get_cache_key(other_value))
+            self.assertEqual(by_value(value), by_value(other_value))
+
+        different_values = [
+            None, True, 1, 1.0, '1', 'True', 'N', [], [1, 2], [12], ['1,2'], [[1], 2], [1, [2]],
+            {}, {'a': 1}, {('a', 1)}, [('a', 1)], set(), {1, 2}, dt, dt.replace(tzinfo=None),
+            uuid.UUID(int=0), str(uuid.UUID(int=0)),
+        ]
+        keys = [by_value.get_cache_key(value) for value in different_values]
+        self.assertEqual(len(set(keys)), len(keys))
+
+        compact_key, readable_key = by_value.describe_cache_key('name')
+        self.assertEqual(compact_key, key)
+        self.assertRegex(readable_key, 'quickcache.by_value.[a-z0-9]{8}/u[a-z0-9]{32}')
+
+    def test_compact_key_collision_rate(self):
+        # The compact key is a 96-bit digest. By the birthday bound,
+        # n keys are expected to have n * (n - 1) / 2 / 2 ** bits collisions,
+        # i.e. ~6e-12 for a billion keys at 96 bits, which is too few to observe.
+        # Instead check that the digest is uniform enough to match that bound
+        # when truncated to 24 bits, and that there are no collisions at full length.
+        import base64
+
+        @quickcache(['a', 'b'], key_format='compact')
+        def pair(a, b):
+            pass
+
+        n = 20000
+        digests = [base64.urlsafe_b64decode(pair.get_cache_key(i, 'value{}'.format(i % 7))[3:])
+                   for i in range(n)]
+        self.assertEqual(len(set(digests)), n)
+
+        expected = n * (n - 1) / 2 / 2 ** 24  # ~11.9
+        collisions = n - len({digest[:3] for digest in digests})
+        self.assertGreater(collisions, expected / 4)
+        self.assertLess(collisions, expected * 3)
+
+    def test_helper_class_with_original_signature(self):
+        class CustomHelper(QuickCacheHelper):
+            def __init__(self, fn, vary_on, cache, skip_arg=None, assert_function=None):
+                super(CustomHelper, self).__init__(fn, vary_on, cache, skip_arg, assert_function)
+
+        @quickcache(['name'], cache=_cache_with_set, helper_class=CustomHelper)
+        def by_name(name):
+            BUFFER.append('called')
+            return 'VALUE'
+
+        self.assertEqual(by_name('name'), 'VALUE')
+        self.assertEqual(self.consume_buffer(), ['cache miss', 'called', 'cache set'])
+
+
+class ShardedCacheTest(TestCase):
+
+    def test_keys_are_spread_over_shards(self):
+        shards = [LocMemCache('shard{}'.format(i), timeout=60) for i in range(4)]
+        cache = ShardedCache(shards)
+        for i in range(1000):
+            cache.set('key{}'.format(i), i)
+        for i in range(1000):
+            self.assertEqual(cache.get('key{}'.format(i)), i)
+        sizes = [len(shard._cache) for shard in shards]
+        self.assertEqual(sum(sizes), 1000)
+        for size in sizes:
+            self.assertGreater(size, 150)
+
+    def test_removing_a_shard_only_moves_its_keys(self):
+        shards = {'shard{}'.format(i): LocMemCache('shard{}'.format(i), timeout=60) for i in range(5)}
+        before = ShardedCache(shards)
+        after = ShardedCache({name: shard for name, shard in shards.items() if name != 'shard2'})
+        for i in range(1000):
+            key = 'key{}'.format(i)
+            if before.get_shard(key) is not shards['shard2']:
+                self.assertIs(after.get_shard(key), before.get_shard(key))
+
+    def test_failing_shard_falls_through_to_compute(self):
+        shards = {'good': LocMemCache('good', timeout=60), 'bad': BrokenCache()}
+        cache = ShardedCache(shards)
+        bad_key = next(k for k in ('key{}'.format(i) for i in range(100))
+                       if cache.get_shard(k) is shards['bad'])
+        cache.set(bad_key, 'VALUE')
+        self.assertEqual(cache.get(bad_key, default=Ellipsis), Ellipsis)
+        cache.delete(bad_key)
+
+        sharded_quickcache = get_quickcache(cache=cache)
+
+        @sharded_quickcache(['name'])
+        def by_name(name):
+            BUFFER.append('called')
+            return name
+
+        names = ['name{}'.format(i) for i in range(20)]
+        for _ in range(2):
+            self.assertEqual([by_name(name) for name in names], names)
+        bad_calls = sum(1 for name in names if cache.get_shard(by_name.get_cache_key(name)) is shards['bad'])
+        self.assertGreater(bad_calls, 0)
+        self.assertEqual(len(BUFFER), len(names) + bad_calls)
+        del BUFFER[:]
+
+    def test_force_skip_cache_is_not_logged(self):
+        cache = ShardedCache([SkippedCache(), SkippedCache()])
+        with mock.patch('quickcache.cache_helpers.logger') as logger:
+            cache.set('key', 'VALUE')
+            self.assertEqual(cache.get('key', default=Ellipsis), Ellipsis)
+            cache.delete('key')
+            cache.set_many({'key{}'.format(i): i for i in range(10)})
+            self.assertEqual(cache.get_many(['key{}'.format(i) for i in range(10)]), {})
+            cache.delete_many(['key{}'.format(i) for i in range(10)])
+        self.assertFalse(logger.warning.called)
+
+    def test_bulk_operations(self):
+        shards = {'a': LocMemCache('a', timeout=60), 'b': LocMemCache('b', timeout=60), 'bad': BrokenCache()}
+        cache = ShardedCache(shards)
+        mapping = {'key{}'.format(i): i for i in range(100)}
+        cache.set_many(mapping)
+        found = cache.get_many(list(mapping))
+        expected = {key: value for key, value in mapping.items() if cache.get_shard(key) is not shards['bad']}
+        self.assertEqual(found, expected)
+        self.assertLess(len(found), len(mapping))
+        cache.delete_many(list(mapping))
+        self.assertEqual(cache.get_many(list(mapping)), {})
+
+    def test_composes_with_presets_and_tiers(self):
+        shards = [CacheMock('shard{}'.format(i), timeout=None, silent_set=False) for i in range(3)]
+        cache = TieredCache([
+            CacheWithPresets(CacheMock('local', timeout=None), timeout=10),
+            CacheWithPresets(ShardedCache(shards), timeout=5 * 60),
+        ])
+
+        tiered_quickcache = get_quickcache(cache=cache)
+
+        @tiered_quickcache([])
+        def simple():
+            BUFFER.append('called')
+            return 'VALUE'
+
+        shard_name = ShardedCache(shards).get_shard(simple.get_cache_key()).name
+        self.assertEqual(simple(), 'VALUE')
+        self.assertEqual(BUFFER, ['local miss', '{} miss'.format(shard_name), 'called',
+                                  '{} set'.format(shard_name)])
+        del BUFFER[:]
+        self.assertEqual(simple(), 'VALUE')
+        self.assertEqual(BUFFER, ['local hit'])
+        del BUFFER[:]
+
+
+class RefreshAheadTest(TestCase):
+
+    def tearDown(self):
+        del BUFFER[:]
+
+    def test_heavy_hitters_keeps_frequent_keys(self):
+        sketch = HeavyHitters(capacity=5)
+        for i in range(1000):
+            sketch.add('hot', 'hot payload')
+            if i % 2:
+                sketch.add('warm', 'warm payload')
+            sketch.add('cold{}'.format(i), None)
+        self.assertLessEqual(len(sketch), 5)
+        self.assertEqual(sketch.top(2), [('hot', 'hot payload'), ('warm', 'warm payload')])
+
+    def test_heavy_hitters_counts(self):
+        rand = random.Random(0)
+        stream = [rand.choice('abcdefghij') for _ in range(2000)]
+        exact = HeavyHitters(capacity=10)
+        for key in stream:
+            exact.add(key, key.upper())
+        expected = sorted(set(stream), key=stream.count, reverse=True)
+        self.assertEqual([exact.count(key) for key in expected], [stream.count(key) for key in expected])
+        self.assertEqual([key for key, _ in exact.top(3)], expected[:3])
+        self.assertEqual(exact.get('a'), 'A')
+
+        # when full, counts are overestimates by at most the smallest count
+        sketch = HeavyHitters(capacity=5)
+        for key in stream:
+            sketch.add(key, None)
+        self.assertEqual(len(sketch), 5)
+        for key, _ in sketch.top(5):
+            self.assertGreaterEqual(sketch.count(key), stream.count(key))
+        self.assertEqual(sum(sketch.count(key) for key, _ in sketch.top(5)), len(stream))
+
+    def test_refreshes_short_lived_instances(self):
+        refresh_ahead = RefreshAhead(timeout=60, lead_time=60, cpu_budget=1, autostart=False)
+        self.addCleanup(refresh_ahead.stop)
+
+        class Item(object):
+
+            def __init__(self, id):
+                self.id = id
+
+            @quickcache(['self.id'], cache=CacheMock('cache', timeout=60), refresh_ahead=refresh_ahead)
+            def get_id(self):
+                BUFFER.append('called')
+                return self.id
+
+        # e.g. a new instance per request
+        Item(1).get_id()
+        Item(1).get_id()
+        del BUFFER[:]
+        for future in refresh_ahead.tick():
+            future.result()
+        self.assertEqual(BUFFER, ['called'])
+
+    def test_refreshes_hot_keys_only(self):
+        timeout = 10 * SHORT_TIME_UNIT
+        refresh_ahead = RefreshAhead(timeout=timeout, lead_time=timeout / 2, top_k=1,
+                                     cpu_budget=1, autostart=False)
+        self.addCleanup(refresh_ahead.stop)
+
+        @quickcache(['name'], cache=CacheMock('cache', timeout=timeout), refresh_ahead=refresh_ahead)
+        def by_name(name):
+            BUFFER.append('called {}'.format(name))
+            return name
+
+        by_name('hot')
+        by_name('cold')
+        self.assertEqual(BUFFER, ['cache miss', 'called hot', 'cache miss', 'called cold'])
+        del BUFFER[:]
+
+        # nothing is about to expire yet
+        self.assertEqual(refresh_ahead.tick(), [])
+
+        time.sleep(timeout / 2)
+        by_name('hot')
+        self.assertEqual(BUFFER, ['cache hit'])
+        del BUFFER[:]
+        futures = refresh_ahead.tick()
+        self.assertEqual(len(futures), 1)
+        for future in futures:
+            future.result()
+        self.assertEqual(BUFFER, ['called hot'])
+        del BUFFER[:]
+
+        # the hot key has been pushed back; the cold one expires
+        time.sleep(timeout / 2 + SHORT_TIME_UNIT)
+        by_name('hot')
+        by_name('cold')
+        self.assertEqual(BUFFER, ['cache hit', 'cache miss', 'called cold'])
+
+
+class HooksTest(TestCase):
+
+    def tearDown(self):
+        del BUFFER[:]
+
+    def test_hooks(self):
+        cache = TieredCache([CacheMock('local', timeout=60), CacheMock('shared', timeout=60)])
+
+        @quickcache(['name'], cache=cache, hooks=RecordingHooks())
+        def by_name(name):
+            BUFFER.append('called')
+            if name == 'bad':
+                raise ValueError(name)
+            return name
+
+        self.assertEqual(by_name('name'), 'name')
+        self.assertEqual(BUFFER, [
+            'before lookup',
+            'local miss', 'local miss hook', 'shared miss', 'shared miss hook',
+            'miss', 'compute start', 'called', 'compute end None', 'set', 'end',
+        ])
+        del BUFFER[:]
+        self.assertEqual(by_name('name'), 'name')
+        self.assertEqual(BUFFER, ['before lookup', 'local hit', 'local hit hook', 'end'])
+        del BUFFER[:]
+
+        with self.assertRaises(ValueError):
+            by_name('bad')
+        self.assertEqual(BUFFER[-3:], ['called', "compute end ValueError('bad')", 'end'])
+
+    def test_hooks_on_skip(self):
+        @quickcache(['name'], cache=CacheMock('cache', timeout=60), skip_arg='force',
+                    hooks=RecordingHooks())
+        def by_name(name, force=False):
+            BUFFER.append('called')
+            return name
+
+        self.assertEqual(by_name('name', force=True), 'name')
+        self.assertEqual(BUFFER, [
+            'before lookup', 'compute start', 'called', 'compute end None', 'set', 'end',
+        ])
+
+    def test_sampled_hooks(self):
+        @quickcache(['name'], cache=CacheMock('cache', timeout=60),
+                    hooks=SampledHooks(RecordingHooks(), every=3))
+        def by_name(name):
+            return name
+
+        for _ in range(6):
+            by_name('name')
+        self.assertEqual(BUFFER.count('before lookup'), 2)
+        self.assertEqual(BUFFER.count('end'), 2)
+        self.assertEqual(BUFFER.count('cache hit') + BUFFER.count('cache miss'), 6)
+
+    def test_profiler_hooks(self):
+        import cProfile
+        import io
+        import pstats
+
+        hooks = ProfilerHooks(profile=cProfile.Profile())
+
+        def expensive(name):
+            return name * 2
+
+        cache = TieredCache([CacheMock('local', timeout=60), CacheMock('shared', timeout=60)])
+
+        @quickcache(['name'], cache=cache, hooks=hooks)
+        def by_name(name):
+            return expensive(name)
+
+        for _ in range(3):
+            by_name('name')
+        self.assertEqual(hooks.stats[('by_name', 'call')][0], 3)
+        self.assertEqual(hooks.stats[('by_name', 'compute')][0], 1)
+        self.assertEqual(hooks.stats[('by_name', 'tier:0')][0], 3)
+        self.assertEqual(hooks.stats[('by_name', 'tier:1')][0], 1)
+
+        stream = io.StringIO()
+        hooks.print_stats(stream)
+        self.assertIn('by_name:compute', stream.getvalue())
+        stream = io.StringIO()
+        pstats.Stats(hooks.profile, stream=stream).print_stats()
+        self.assertIn('expensive', stream.getvalue())
+
+
+class HedgedTieredCacheTest(TestCase):
+
+    def tearDown(self):
+        del BUFFER[:]
+
+    def test_slow_tier_is_hedged(self):
+        local = CacheMock('local', timeout=60)
+        middle = SlowCache('middle', timeout=60, delay=50 * SHORT_TIME_UNIT)
+        shared = CacheMock('shared', timeout=60)
+        cache = TieredCache([local, middle, shared], hedge_delay=SHORT_TIME_UNIT)
+        shared.set('key', 'VALUE')
+
+        start = time.time()
+        self.assertEqual(cache.get('key'), 'VALUE')
+        self.assertLess(time.time() - start, 25 * SHORT_TIME_UNIT)
+        self.assertEqual(BUFFER, ['local miss', 'shared hit'])
+        # earlier tiers are backfilled as usual
+        self.assertEqual(local.get('key'), 'VALUE')
+        self.assertEqual(LocMemCache.get(middle, 'key'), 'VALUE')
+
+    def test_earliest_hit_wins(self):
+        local = CacheMock('local', timeout=60)
+        middle = CacheMock('middle', timeout=60)
+        shared = CacheMock('shared', timeout=60)
+        cache = TieredCache([local, middle, shared], hedge_delay=10)
+        middle.set('key', 'MIDDLE')
+        shared.set('key', 'SHARED')
+        self.assertEqual(cache.get('key'), 'MIDDLE')
+        self.assertEqual(BUFFER, ['local miss', 'middle hit'])
+        del BUFFER[:]
+
+        self.assertEqual(cache.get('missing', default='DEFAULT'), 'DEFAULT')
+        self.assertEqual(BUFFER, ['local miss', 'middle miss', 'shared miss'])
+
+    def test_two_tiers_are_not_hedged(self):
+        local = CacheMock('local', timeout=60)
+        shared = CacheMock('shared', timeout=60)
+        cache = TieredCache([local, shared], hedge_delay=SHORT_TIME_UNIT)
+        shared.set('key', 'VALUE')
+        self.assertEqual(cache.get('key'), 'VALUE')
+        self.assertEqual(BUFFER, ['local miss', 'shared hit'])
+        self.assertIsNone(cache._pool._executor)
+
+    def test_last_tier_in_calling_thread(self):
+        threads = []
+
+        class ThreadRecordingCache(LocMemCache):
+            def get(self, key, default=None):
+                threads.append(threading.current_thread())
+                return super(ThreadRecordingCache, self).get(key, default)
+
+        local = LocMemCache('local', timeout=60)
+        middle = SlowCache('middle', timeout=60, delay=20 * SHORT_TIME_UNIT)
+        shared = ThreadRecordingCache('shared', timeout=60)
+        cache = TieredCache([local, middle, shared], hedge_delay=SHORT_TIME_UNIT)
+        self.assertEqual(cache.get('key', default='DEFAULT'), 'DEFAULT')
+        self.assertEqual(threads, [threading.current_thread()])
+
+
+class ConcurrencyTest(TestCase):
+
+    def _get_in_thread(self, cache, key):
+        result = []
+        thread = threading.Thread(target=lambda: result.append(cache.get(key, default=Ellipsis)))
+        thread.start()
+        return thread, result
+
+    def test_delete_wins_over_backfill(self):
+        local = LocMemCache('local', timeout=60)
+        shared = BlockingCache('shared', timeout=60)
+        cache = TieredCache([local, shared])
+        LocMemCache.set(shared, 'key', 'STALE')
+
+        thread, result = self._get_in_thread(cache, 'key')
+        shared.reading.wait()
+        # the get has read 'STALE' from the shared cache but not backfilled yet
+        cache.delete('key')
+        shared.release.set()
+        thread.join()
+
+        self.assertEqual(result, ['STALE'])
+        self.assertEqual(local.get('key', Ellipsis), Ellipsis)
+        self.assertEqual(LocMemCache.get(shared, 'key', Ellipsis), Ellipsis)
+
+    def test_set_wins_over_backfill(self):
+        local = LocMemCache('local', timeout=60)
+        shared = BlockingCache('shared', timeout=60)
+        cache = TieredCache([local, shared])
+        LocMemCache.set(shared, 'key', 'STALE')
+
+        thread, result = self._get_in_thread(cache, 'key')
+        shared.reading.wait()
+        cache.set('key', 'FRESH')
+        shared.release.set()
+        thread.join()
+
+        self.assertEqual(result, ['STALE'])
+        self.assertEqual(local.get('key'), 'FRESH')
+        self.assertEqual(cache.get('key'), 'FRESH')
+
+    def test_stress(self):
+        local = LocMemCache('local', timeout=60)
+        shared = LocMemCache('shared', timeout=60)
+        cache = TieredCache([local, shared])
+
+        tiered_quickcache = get_quickcache(cache=cache)
+
+        @tiered_quickcache(['n'])
+        def square(n):
+            return n * n
+
+        keys = list(range(8))
+        errors = []
+
+        def hammer(seed):
+            rand = random.Random(seed)
+            try:
+                for _ in range(2000):
+                    n = rand.choice(keys)
+                    action = rand.random()
+                    if action < 0.5:
+                        self.assertIn(square(n), (n * n, ('set', n)))
+                    elif action < 0.7:
+                        square.clear(n)
+                    elif action < 0.8:
+                        square.set_cached_value(n).to(('set', n))
+                    elif action < 0.9:
+                        # only the local cache loses it, e.g. by expiring
+                        local.delete(square.get_cache_key(n))
+                    else:
+                        cache.get(square.get_cache_key(n))
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=hammer, args=(seed,)) for seed in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+        # the local cache never has a value that the shared cache doesn't
+        for n in keys:
+            key = square.get_cache_key(n)
+            local_value = local.get(key, Ellipsis)
+            if local_value is not Ellipsis:
+                self.assertEqual(shared.get(key, Ellipsis), local_value)
+
+        # and once cleared nothing comes back
+        for n in keys:
+            square.clear(n)
+        threads = [threading.Thread(target=lambda: [cache.get(square.get_cache_key(n)) for n in keys])
+                   for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(local._cache, {})
+        self.assertEqual(shared._cache, {})
+
+
+class OffloadTest(TestCase):
+
+    def tearDown(self):
+        del BUFFER[:]
+
+    def test_offload_to_process(self):
+        pid, square = square_in_process(3)
+        self.assertNotEqual(pid, os.getpid())
+        self.assertEqual(square, 9)
+        self.assertEqual(BUFFER, ['local miss', 'shared miss'])
+        del BUFFER[:]
+
+        self.assertEqual(square_in_process(3), (pid, 9))
+        self.assertEqual(square_in_process.submit(3).result(), (pid, 9))
+        self.assertEqual(BUFFER, ['local hit', 'local hit'])
+
+    def test_offload_to_process_keeps_inner_decorators(self):
+        self.assertEqual(tagged_in_process(1), ('wrapped', 1))
+
+    def test_offload_dedupes_in_flight(self):
+        release = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=4)
+        self.addCleanup(executor.shutdown)
+
+        @quickcache(['name'], cache=CacheMock('cache', timeout=60), offload=executor)
+        def by_name(name):
+            release.wait()
+            BUFFER.append('called')
+            return name
+
+        first = by_name.submit('name')
+        second = by_name.submit('name')
+        self.assertIs(first, second)
+        self.assertFalse(first.done())
+        # shared with the other waiters, so it can't be cancelled
+        self.assertFalse(first.cancel())
+        release.set()
+        self.assertEqual(first.result(), 'name')
+        self.assertEqual(BUFFER, ['cache miss', 'cache miss', 'called'])
+        del BUFFER[:]
+
+        # stored through the cache
+        self.assertEqual(by_name('name'), 'name')
+        self.assertEqual(BUFFER, ['cache hit'])
+
+    def test_offload_timeout_falls_back_to_stale_value(self):
+        release = threading.Event()
+        release.set()
+        values = iter(['first', 'second'])
+        executor = ThreadPoolExecutor(max_workers=1)
+        self.addCleanup(executor.shutdown)
+
+        cache = CacheMock('cache', timeout=60)
+
+        @quickcache([], cache=cache, offload=executor, offload_timeout=SHORT_TIME_UNIT)
+        def get_value():
+            release.wait()
+            return next(values)
+
+        self.assertEqual(get_value(), 'first')
+        # let the cached value expire
+        cache._cache.clear()
+        release.clear()
+        # the cached value has expired and the recompute is slow
+        self.assertEqual(get_value(), 'first')
+        release.set()
+        self.assertEqual(get_value.submit().result(), 'second')
+
+    def test_submit_like_a_call(self):
+        executor = ThreadPoolExecutor(max_workers=2)
+        self.addCleanup(executor.shutdown)
+        cache = CacheMock('cache', timeout=60)
+        refresh_ahead = RefreshAhead(timeout=60, autostart=False)
+
+        class Item(object):
+
+            def __init__(self, id):
+                self.id = id
+
+            @quickcache(['self.id'], cache=cache, skip_arg='force', offload=executor,
+                        memoize_on_instance=True, refresh_ahead=refresh_ahead,
+                        hooks=RecordingHooks())
+            def get_id(self, force=False):
+                BUFFER.append('called')
+                return self.id
+
+        item = Item(1)
+        self.assertEqual(Item.get_id.submit(item).result(), 1)
+        self.assertEqual(sorted(BUFFER), sorted([
+            'before lookup', 'cache miss', 'cache miss hook', 'miss', 'end', 'called',
+        ]))
+        del BUFFER[:]
+        key = Item.get_id.get_cache_key(item)
+        stats, = refresh_ahead._stats.values()
+        self.assertEqual(stats.sketch.count(key), 1)
+
+        # memoized on the instance
+        self.assertEqual(Item.get_id.submit(item).result(), 1)
+        self.assertEqual(BUFFER, [])
+
+        # skip_arg skips the memo and the cache
+        self.assertEqual(Item.get_id.submit(item, force=True).result(), 1)
+        self.assertEqual(sorted(BUFFER), sorted(['before lookup', 'end', 'called']))
+
+    def test_offload_stores_outside_executor_callback(self):
+        threads = []
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='test-offload')
+        self.addCleanup(executor.shutdown)
+
+        class ThreadRecordingCache(LocMemCache):
+            def set(self, key, value, timeout=None):
+                threads.append(threading.current_thread().name)
+                super(ThreadRecordingCache, self).set(key, value)
+
+        @quickcache(['name'], cache=ThreadRecordingCache('cache', timeout=60), offload=executor)
+        def by_name(name):
+            return name
+
+        self.assertEqual(by_name('name'), 'name')
+        self.assertEqual(len(threads), 1)
+        self.assertTrue(threads[0].startswith('quickcache-offload-store'))
+
+    def test_offload_validation(self):
+        with self.assertRaises(ValueError):
+            @quickcache([], offload=True)
+            def nested():
+                pass
+
+        with self.assertRaises(ValueError):
+            @quickcache([], offload_timeout=1)
+            def no_offload():
+                pass
+
+        @quickcache([])
+        def not_offloaded():
+            pass
+
+        with self.assertRaises(ValueError):
+            not_offloaded.submit()
+
+
+class OpenTelemetryHooksTest(TestCase):
+
+    def setUp(self):
+        try:
+            from opentelemetry.sdk.trace import TracerProvider
+            from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+            from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+            from quickcache.opentelemetry_hooks import OpenTelemetryHooks
+        except ImportError:
+            self.skipTest('opentelemetry is not installed')
+        self.exporter = InMemorySpanExporter()
+        provider = TracerProvider()
+        provider.add_span_processor(SimpleSpanProcessor(self.exporter))
+        self.tracer = provider.get_tracer('test')
+        self.hooks = OpenTelemetryHooks(self.tracer)
+
+    def test_spans(self):
+        tracer = self.tracer
+
+        @quickcache(['name'], cache=TieredCache([LocMemCache('local', 60), LocMemCache('shared', 60)]),
+                    hooks=self.hooks)
+        def by_name(name):
+            with tracer.start_as_current_span('inside'):
+                if name == 'bad':
+                    raise ValueError(name)
+                return name
+
+        self.assertEqual(by_name('name'), 'name')
+        spans = {span.name: span for span in self.exporter.get_finished_spans()}
+        self.assertEqual(
+            sorted(spans),
+            ['inside', 'quickcache by_name', 'quickcache.compute', 'quickcache.get',
+             'quickcache.key', 'quickcache.set'])
+        call_span = spans['quickcache by_name']
+        self.assertEqual(spans['quickcache.compute'].parent.span_id, call_span.context.span_id)
+        # spans started by the function nest under the recompute
+        self.assertEqual(spans['inside'].parent.span_id, spans['quickcache.compute'].context.span_id)
+        self.assertEqual(len([span for span in self.exporter.get_finished_spans()
+                              if span.name == 'quickcache.get']), 2)
+
+        self.exporter.clear()
+        with self.assertRaises(ValueError):
+            by_name('bad')
+        spans = {span.name: span for span in self.exporter.get_finished_spans()}
+        self.assertFalse(spans['quickcache.compute'].status.is_ok)
+        self.assertTrue(spans['quickcache by_name'].end_time)